@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+__author__ = 'k_morishita'
+
+"""
+ゲームと Agent の速さを測って JSON で出力する.
+
+    python benchmark.py [--steps 20000] [--agent-steps 300] [--seed 0] [--output result.json]
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from game_common.ascii_game_player_agent import AsciiGamePlayerAgent, play_headless
+from game_common.game_repository import GameRepository
+from game_common.model_builder import build_ptn1_model
+from game_common.replay_server import ReplayServer
+from jump_game import JumpGame, VecJumpGame
+from treasure_game import TreasureGame, VecTreasureGame
+
+GAMES = [
+    ("JumpGame", JumpGame, VecJumpGame),
+    ("TreasureGame", TreasureGame, VecTreasureGame),
+]
+
+
+class Stopwatch(object):
+    """wrap() した関数の呼び出し回数と合計時間を数える"""
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def wrap(self, func):
+        def wrapped(*args, **kw):
+            t1 = time.time()
+            try:
+                return func(*args, **kw)
+            finally:
+                self.elapsed += time.time() - t1
+                self.count += 1
+        return wrapped
+
+    def msec_per_call(self):
+        return 1000.0 * self.elapsed / max(self.count, 1)
+
+
+def seed_all(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+
+
+def bench_game(game_class, steps, seed):
+    """headless で random に step() した時の steps/sec"""
+    rnd = random.Random(seed)
+    game = game_class(None)
+    game.headless = True
+    actions = game.effective_actions()
+    game.reset()
+    t1 = time.time()
+    for _ in range(steps):
+        game.step(rnd.choice(actions))
+        if game.is_game_over:
+            game.reset()
+    elapsed = time.time() - t1
+    return {"steps": steps, "steps_per_sec": steps / elapsed}
+
+
+def bench_vec_game(vec_game_class, steps, seed, num_games=256):
+    rnd = np.random.RandomState(seed)
+    vec_game = vec_game_class(num_games)
+    actions = np.array(vec_game.action_space.actions)
+    t1 = time.time()
+    for _ in range(steps):
+        vec_game.step(actions[rnd.randint(len(actions), size=num_games)])
+    elapsed = time.time() - t1
+    return {"num_games": num_games, "steps": steps, "game_steps_per_sec": num_games * steps / elapsed}
+
+
+def bench_agent(game_class, steps, seed, repo_dir):
+    """AsciiGamePlayerAgent.action() 1回にかかる時間を history/update/forward に分けて測る"""
+    seed_all(seed)
+    repo = GameRepository(repo_dir)
+    repo.save_model_data = lambda model_name, data: None  # 保存は bench_repository で測る
+    agent = AsciiGamePlayerAgent(build_ptn1_model(game_class, "benchmark_%s" % game_class.__name__), repo=repo)
+    watches = dict((name, Stopwatch()) for name in ("action", "history", "update", "forward"))
+    agent.action = watches["action"].wrap(agent.action)
+    agent.update_history = watches["history"].wrap(agent.update_history)
+    agent.update_q_table = watches["update"].wrap(agent.update_q_table)
+    agent.current_q_values = watches["forward"].wrap(agent.current_q_values)
+
+    game = game_class(agent)
+    game.headless = True
+    agent.set_action_space(game.ACTION_SPACE)
+    while watches["action"].count < steps:
+        play_headless(game, agent)
+    return dict(("%s_msec" % name, w.msec_per_call()) for name, w in watches.items())
+
+
+def bench_repository(game_class, repeat, seed, repo):
+    seed_all(seed)
+    model = build_ptn1_model(game_class, "benchmark_repo_%s" % game_class.__name__)
+    save, load = Stopwatch(), Stopwatch()
+    for _ in range(repeat):
+        save.wrap(repo.save_model_params)(model)
+        load.wrap(repo.load_model_params)(model)
+    return {
+        "save_msec": save.msec_per_call(),
+        "load_msec": load.msec_per_call(),
+        "file_bytes": os.path.getsize(repo.get_model_path(model.model_name)),
+    }
+
+
+def bench_replay_server(game_class, scenes, repeat, seed):
+    """1ゲーム分(scenes 画面)の replay を pickle する時間"""
+    rnd = random.Random(seed)
+    server = ReplayServer()
+    game = game_class(None)
+    game.headless = True
+    game.reset()
+    server.on_game_start(game)
+    for _ in range(scenes):
+        game.step(rnd.choice(game.effective_actions()))
+        server.on_update(game)
+        if game.is_game_over:
+            game.reset()
+    server.on_game_over(game)
+    watch = Stopwatch()
+    for _ in range(repeat):
+        data = watch.wrap(server.serialize)()
+    return {"scenes": scenes, "serialize_msec": watch.msec_per_call(), "bytes": len(data)}
+
+
+def run_all(steps, agent_steps, seed):
+    results = {"seed": seed, "steps": steps, "agent_steps": agent_steps}
+    repo_dir = tempfile.mkdtemp(prefix="game_benchmark_")
+    try:
+        repo = GameRepository(repo_dir)
+        for name, game_class, vec_game_class in GAMES:
+            results[name] = {
+                "headless": bench_game(game_class, steps, seed),
+                "vectorized": bench_vec_game(vec_game_class, max(steps / 10, 1), seed),
+                "agent": bench_agent(game_class, agent_steps, seed, repo_dir),
+                "repository": bench_repository(game_class, 5, seed, repo),
+                "replay_server": bench_replay_server(game_class, 1000, 5, seed),
+            }
+    finally:
+        shutil.rmtree(repo_dir)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Game/Agent benchmark")
+    parser.add_argument("--steps", type=int, default=20000, help="steps for headless game benchmarks")
+    parser.add_argument("--agent-steps", type=int, default=300, help="steps for agent benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run_all(args.steps, args.agent_steps, args.seed)
+    if args.output:
+        with file(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+__author__ = 'k_morishita'
+
+"""
+保存済みのモデルの重みを float16 / int8 にした時に、float32 と比べて Q値と選ぶ action がどれくらい変わるかを測る.
+ゲームを何回か遊んで集めた画面で、精度毎に Q値の誤差、action の一致率、重みのバイト数、1画面の推論時間を JSON で出力する.
+
+    python compare_precision.py JumpGame [--model JumpGame] [--episodes 10] [--seed 0]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from evaluate import GAMES
+from game_common.ascii_game_player_agent import AsciiGamePlayerAgent
+from game_common.game_repository import GameRepository
+from game_common.model_builder import build_ptn1_model
+from game_common.numpy_inference import NumpyInference, PRECISIONS
+
+
+def collect_histories(game, agent, episodes, seed, max_turns):
+    """E_GREEDY で遊んで、action を選んだ時の入力 [history_size, height, width] を集める"""
+    histories = []
+    for k in range(episodes):
+        game.set_seed(seed + k)
+        state = game.reset()
+        agent.on_game_start(game)
+        reward = 0
+        is_game_over = False
+        while not is_game_over and game.turn < max_turns:
+            action = agent.action(state, reward)
+            histories.append(agent.state_history_array[:agent.agent_model.history_size].copy())
+            state, reward, is_game_over, _ = game.step(action)
+    return np.array(histories, dtype=np.float32)
+
+
+def compare(agent, histories, batch_size=64):
+    """:return: {precision: 結果の dict}"""
+    model = agent.agent_model
+    mask = agent.action_mask if agent.action_mask is not None else np.ones([len(agent.actions)], dtype=np.bool_)
+    results = {}
+    reference = None
+    for precision in PRECISIONS:
+        inference = NumpyInference(model, precision=precision)
+        q = np.concatenate([inference(histories[i:i+batch_size]) for i in range(0, len(histories), batch_size)])
+        start_time = time.time()
+        for history in histories[:100]:
+            inference(history[np.newaxis])
+        usec = (time.time() - start_time) / min(len(histories), 100) * 1e6
+        actions = np.argmax(q[:, mask], axis=1)
+        if reference is None:
+            reference = (q, actions)
+        error = np.abs(q - reference[0])[:, mask]
+        results[precision] = {
+            "weight_bytes": inference.weight_bytes(),
+            "usec_per_state": usec,
+            "q_max_abs_error": float(error.max()),
+            "q_mean_abs_error": float(error.mean()),
+            "q_relative_error": float(error.mean() / max(np.abs(reference[0][:, mask]).mean(), 1e-12)),
+            "action_agreement": float(np.mean(actions == reference[1])),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare reduced-precision inference weights with float32")
+    parser.add_argument("game", choices=sorted(GAMES.keys()))
+    parser.add_argument("--model", help="model name in the repository (default: same as game)")
+    parser.add_argument("--repo-dir", help="GameRepository base dir (default: ~/.game)")
+    parser.add_argument("--episodes", type=int, default=10, help="games played to collect screens")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=1000, help="stop an episode after this many turns")
+    args = parser.parse_args()
+
+    model_name = args.model or args.game
+    repo = GameRepository(args.repo_dir)
+    if not os.path.exists(repo.get_model_path(model_name)):
+        parser.error("model not found: %s" % repo.get_model_path(model_name))
+
+    np.random.seed(args.seed)
+    game_class = GAMES[args.game]
+    model = build_ptn1_model(game_class, model_name)
+    agent = AsciiGamePlayerAgent(model, repo=repo, replay_memory_size=0)
+    agent.training = False
+    game = game_class(agent)
+    game.headless = True
+    agent.set_action_space(game.ACTION_SPACE)
+
+    histories = collect_histories(game, agent, args.episodes, args.seed, args.max_turns)
+    result = {
+        "game": args.game,
+        "model": model_name,
+        "states": len(histories),
+        "precisions": compare(agent, histories),
+    }
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    print
+
+
+if __name__ == '__main__':
+    main()
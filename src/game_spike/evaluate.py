@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+__author__ = 'k_morishita'
+
+"""
+保存済みのモデルを greedy に K ゲーム遊ばせて、得点とターン数の統計を JSON で出力する.
+学習中のプロセスとは別に動かせる. ゲーム k は seed+k で作るので、同じ引数なら毎回同じゲームになる.
+
+    python evaluate.py JumpGame [--model JumpGame] [--episodes 100] [--processes 4] [--seed 0]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+from game_common.ascii_game_player_agent import AsciiGamePlayerAgent
+from game_common.game_repository import GameRepository
+from game_common.model_builder import build_ptn1_model
+from jump_game import JumpGame
+from treasure_game import TreasureGame
+
+GAMES = {
+    "JumpGame": JumpGame,
+    "TreasureGame": TreasureGame,
+}
+PERCENTILES = [10, 25, 50, 75, 90]
+
+worker_game = None
+worker_agent = None
+
+
+def init_worker(game_name, model_name, repo_dir):
+    """Pool の各プロセスで1回だけモデルを読み込む"""
+    global worker_game, worker_agent
+    game_class = GAMES[game_name]
+    model = build_ptn1_model(game_class, model_name)
+    worker_agent = AsciiGamePlayerAgent(model, repo=GameRepository(repo_dir), replay_memory_size=0)
+    worker_agent.training = False
+    worker_agent.use_greedy = False
+    worker_game = game_class(worker_agent)
+    worker_game.headless = True
+    worker_agent.set_action_space(worker_game.ACTION_SPACE)
+
+
+def run_episode(args):
+    seed, max_turns = args
+    return play_greedy(worker_game, worker_agent, seed, max_turns)
+
+
+def play_greedy(game, agent, seed, max_turns):
+    """
+    学習せずに1ゲーム遊ぶ(agent.training, use_greedy は呼ぶ側で False にしておく).
+
+    :return: (total_reward, turn)
+    """
+    game.set_seed(seed)
+    state = game.reset()
+    agent.on_game_start(game)
+    reward = 0
+    is_game_over = False
+    while not is_game_over and game.turn < max_turns:
+        state, reward, is_game_over, _ = game.step(agent.action(state, reward))
+    return game.total_reward, game.turn
+
+
+def describe(values):
+    values = np.asarray(values, dtype=np.float64)
+    result = {
+        "mean": values.mean(),
+        "std": values.std(),
+        "min": values.min(),
+        "max": values.max(),
+    }
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        result["p%d" % p] = v
+    return result
+
+
+def evaluate(game_name, model_name, repo_dir, episodes, processes, seed, max_turns):
+    tasks = [(seed + k, max_turns) for k in range(episodes)]
+    pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=(game_name, model_name, repo_dir))
+    try:
+        results = pool.map(run_episode, tasks)
+    finally:
+        pool.terminate()
+    scores, turns = zip(*results)
+    return {
+        "game": game_name,
+        "model": model_name,
+        "episodes": episodes,
+        "seed": seed,
+        "max_turns": max_turns,
+        "score": describe(scores),
+        "turns": describe(turns),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a saved model with greedy play")
+    parser.add_argument("game", choices=sorted(GAMES.keys()))
+    parser.add_argument("--model", help="model name in the repository (default: same as game)")
+    parser.add_argument("--repo-dir", help="GameRepository base dir (default: ~/.game)")
+    parser.add_argument("--episodes", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-turns", type=int, default=10000, help="stop an episode after this many turns")
+    args = parser.parse_args()
+
+    model_name = args.model or args.game
+    repo = GameRepository(args.repo_dir)
+    if not os.path.exists(repo.get_model_path(model_name)):
+        parser.error("model not found: %s" % repo.get_model_path(model_name))
+
+    result = evaluate(args.game, model_name, repo.base_dir, args.episodes, args.processes,
+                      args.seed, args.max_turns)
+    json.dump(result, sys.stdout, indent=2, sort_keys=True)
+    print
+
+
+if __name__ == '__main__':
+    main()
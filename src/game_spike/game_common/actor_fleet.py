@@ -0,0 +1,301 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+"""
+K個の Actor プロセスがそれぞれ自分のゲームを遊び、遷移を共有メモリで1つの Learner に流す.
+Learner は学習した重みを定期的に共有メモリに書き出し、Actor はゲーム開始時にそれを読み込む.
+"""
+
+import ctypes
+import multiprocessing
+import os
+import random
+import time
+
+import numpy as np
+
+from replay_server import ReplayServer
+from frame_stack import FrameStack
+from phase_profiler import create_profiler
+
+
+class SharedTransitionQueue(object):
+    """
+    Actor 1つ分の遷移を流す共有メモリ上のリングバッファ(書くのは Actor, 読むのは Learner だけ).
+    1レコードは Agent が action() で見た1画面分:
+      screen, その画面に至った reward, その画面で選んだ action(index), flag
+    """
+    FLAG_NONE = 0
+    FLAG_GAME_START = 1  # 直前の action が無い
+    FLAG_GAME_OVER = 2   # 最後の画面. action は無い
+
+    def __init__(self, capacity, height, width):
+        self.capacity = capacity
+        self._screens = multiprocessing.RawArray(ctypes.c_int8, capacity * height * width)
+        self._rewards = multiprocessing.RawArray(ctypes.c_float, capacity)
+        self._actions = multiprocessing.RawArray(ctypes.c_int32, capacity)
+        self._flags = multiprocessing.RawArray(ctypes.c_int8, capacity)
+        self._write_count = multiprocessing.RawValue(ctypes.c_long, 0)
+        self.screens = np.ctypeslib.as_array(self._screens).reshape(capacity, height, width)
+        self.rewards = np.ctypeslib.as_array(self._rewards)
+        self.actions = np.ctypeslib.as_array(self._actions)
+        self.flags = np.ctypeslib.as_array(self._flags)
+        self.read_count = 0
+
+    def push(self, screen_data, reward, action, flag):
+        i = self._write_count.value % self.capacity
+        self.screens[i] = screen_data
+        self.rewards[i] = reward
+        self.actions[i] = action
+        self.flags[i] = flag
+        self._write_count.value += 1
+
+    def pop(self, max_count):
+        """
+        まだ読んでいないレコードの index を古い方から max_count 個まで返す.
+        Learner が追いつけずに上書きされた分は捨てる(その場合 lost=True).
+
+        :return: (index list, lost)
+        """
+        write_count = self._write_count.value
+        lost = write_count - self.read_count > self.capacity
+        if lost:
+            self.read_count = write_count - self.capacity
+        end = min(write_count, self.read_count + max_count)
+        indices = [i % self.capacity for i in range(self.read_count, end)]
+        self.read_count = end
+        return indices, lost
+
+
+class SharedParameters(object):
+    """FunctionSet の parameters を共有メモリに置いたもの. version は publish の度に増える"""
+
+    def __init__(self, function_set):
+        self.lock = multiprocessing.Lock()
+        self._version = multiprocessing.RawValue(ctypes.c_long, 0)
+        self._arrays = [multiprocessing.RawArray(ctypes.c_float, p.size) for p in function_set.parameters]
+        self.parameters = [np.ctypeslib.as_array(a).reshape(p.shape)
+                           for a, p in zip(self._arrays, function_set.parameters)]
+        self.publish(function_set)
+
+    @property
+    def version(self):
+        return self._version.value
+
+    def publish(self, function_set):
+        with self.lock:
+            for dst, src in zip(self.parameters, function_set.parameters):
+                dst[...] = src
+            self._version.value += 1
+
+    def fetch(self, function_set):
+        with self.lock:
+            for dst, src in zip(function_set.parameters, self.parameters):
+                dst[...] = src
+            return self._version.value
+
+
+class FleetActor(object):
+    """
+    Actor プロセス側の Player. 中身の AsciiGamePlayerAgent は推論だけ行い、見た画面を queue に流す.
+    """
+
+    def __init__(self, agent_player, queue, shared_parameters):
+        """
+
+        :type agent_player: AsciiGamePlayerAgent
+        :type queue: SharedTransitionQueue
+        :type shared_parameters: SharedParameters
+        """
+        self.agent_player = agent_player
+        self.agent_player.training = False
+        self.queue = queue
+        self.shared_parameters = shared_parameters
+        self.parameters_version = None
+        self.next_flag = SharedTransitionQueue.FLAG_GAME_START
+
+    def action(self, state, last_reward):
+        code = self.agent_player.action(state, last_reward)
+        self.queue.push(state.screen.data, last_reward, self.agent_player.last_action, self.next_flag)
+        self.next_flag = SharedTransitionQueue.FLAG_NONE
+        return code
+
+    def refresh_parameters(self):
+        if self.parameters_version != self.shared_parameters.version:
+            self.parameters_version = self.shared_parameters.fetch(self.agent_player.agent_model.function_set)
+            self.agent_player.on_weights_changed()
+
+    # Game Life cycle
+    def on_game_start(self, game):
+        self.refresh_parameters()
+        self.next_flag = SharedTransitionQueue.FLAG_GAME_START
+
+    def on_game_over(self, game):
+        self.queue.push(game.state.screen.data, game.last_reward, 0, SharedTransitionQueue.FLAG_GAME_OVER)
+
+    def on_update(self, game):
+        pass
+
+
+SEED_STRIDE = 1000000  # Actor 毎のゲームの seed の間隔. actor_id * SEED_STRIDE + 何ゲーム目か
+
+
+def actor_main(actor_id, game_class, agent_player, queue, shared_parameters, base_seed=0):
+    """
+    fork した Actor は親の乱数の状態を引き継ぐので、numpy と random を Actor 毎に seed し直す.
+    ゲームも base_seed + actor_id * SEED_STRIDE + 何ゲーム目か、の seed で Actor とゲーム毎に変える.
+    """
+    np.random.seed(base_seed + actor_id)
+    random.seed(base_seed + actor_id)
+    actor = FleetActor(agent_player, queue, shared_parameters)
+    game = game_class(actor)
+    game.profiler = create_profiler()
+    game.add_observer(agent_player)
+    game.add_observer(actor)
+    agent_player.set_action_space(game.ACTION_SPACE)
+    if actor_id == 0:
+        replay_server = ReplayServer(int(os.environ.get("GAME_SERVER_PORT", 7000)))
+        game.add_observer(replay_server)
+        replay_server.run_as_background()
+
+    while True:
+        if actor_id == 0:
+            replay_server.info = ["e-Greedy=%s" % agent_player.use_greedy,
+                                  "Actors=%s" % os.environ.get("NUM_ACTORS")] + agent_player.agent_model.info_list()
+            if game.profiler is not None:
+                replay_server.info += game.profiler.info_list()
+        game.set_seed(base_seed + actor_id * SEED_STRIDE + game.play_id)
+        game.play()
+        if game.play_id % 10 == 0:
+            agent_player.use_greedy = not agent_player.use_greedy
+
+
+class FleetLearner(object):
+    """
+    全 Actor の queue を順に読み、Actor 毎に state history を組み立てて agent_player で学習する.
+    """
+    PUBLISH_INTERVAL = 100  # 何回学習したら重みを Actor に配るか
+    MAX_RECORDS_PER_POLL = 100  # 1つの Actor から一度に読む数
+    IDLE_SLEEP = 0.001
+
+    def __init__(self, agent_player, queues, shared_parameters):
+        """
+
+        :type agent_player: AsciiGamePlayerAgent
+        """
+        self.agent_player = agent_player
+        self.queues = queues
+        self.shared_parameters = shared_parameters
+        self.frame_stack_list = [self.new_frame_stack() for _ in queues]
+        self.last_action_list = [None] * len(queues)
+        self.episode_reward_list = [0.0] * len(queues)
+        self.episode_count = 0
+        self.episode_id_list = [0] * len(queues)
+        self.skipping_list = [False] * len(queues)  # 読めずに捨てたレコードの後、次のゲーム開始まで読み飛ばす
+        self.update_count = 0
+        self.game_over_count = 0
+
+    def new_frame_stack(self):
+        model = self.agent_player.agent_model
+        return FrameStack(model.history_size+1, model.height, model.width)
+
+    def learn_forever(self):
+        while True:
+            if self.learn_once() == 0:
+                time.sleep(self.IDLE_SLEEP)
+
+    def learn_once(self):
+        num_records = 0
+        for actor_id, queue in enumerate(self.queues):
+            indices, lost = queue.pop(self.MAX_RECORDS_PER_POLL)
+            if lost:
+                self.on_records_lost(actor_id)
+            for i in indices:
+                self.learn_record(actor_id, queue, i)
+            num_records += len(indices)
+        return num_records
+
+    def on_records_lost(self, actor_id):
+        """
+        上書きされて読めなかったレコードがある. 抜けた所の前後をつなげないように、途中まで見たゲームは捨てて
+        次の FLAG_GAME_START まで読み飛ばす(そのゲームは checkpoint や telemetry にも数えない).
+        """
+        self.frame_stack_list[actor_id].reset()
+        self.last_action_list[actor_id] = None
+        self.episode_reward_list[actor_id] = 0.0
+        self.skipping_list[actor_id] = True
+
+    def learn_record(self, actor_id, queue, i):
+        agent = self.agent_player
+        flag = queue.flags[i]
+        frame_stack = self.frame_stack_list[actor_id]
+        if self.skipping_list[actor_id]:
+            if flag != SharedTransitionQueue.FLAG_GAME_START:
+                return
+            self.skipping_list[actor_id] = False
+        agent.telemetry.on_step()
+        if flag == SharedTransitionQueue.FLAG_GAME_START:
+            frame_stack.reset()
+            self.last_action_list[actor_id] = None
+            self.episode_reward_list[actor_id] = 0.0
+            self.episode_count += 1
+            self.episode_id_list[actor_id] = self.episode_count
+        else:
+            self.episode_reward_list[actor_id] += queue.rewards[i]
+
+        frame_stack.push(agent.agent_model.convert_screen_to_input(queue.screens[i]))
+        history = frame_stack.history
+
+        last_action = self.last_action_list[actor_id]
+        if last_action is not None:
+            agent.update_q_table(history, last_action, queue.rewards[i],
+                                 flag == SharedTransitionQueue.FLAG_GAME_OVER, self.episode_id_list[actor_id])
+            self.update_count += 1
+            if self.update_count % self.PUBLISH_INTERVAL == 0:
+                self.shared_parameters.publish(agent.agent_model.function_set)
+
+        if flag == SharedTransitionQueue.FLAG_GAME_OVER:
+            self.last_action_list[actor_id] = None
+            self.on_game_over(self.episode_reward_list[actor_id])
+        else:
+            self.last_action_list[actor_id] = queue.actions[i]
+
+    def on_game_over(self, total_reward):
+        self.game_over_count += 1
+        self.agent_player.checkpointer.on_game_over(total_reward)
+        self.agent_player.telemetry.on_episode(total_reward)
+        self.agent_player.telemetry.maybe_write()
+        self.agent_player.loss_history.ready()
+
+
+def fleet_play(game_class, agent_player, num_actors, queue_capacity=10000, base_seed=0):
+    """
+    num_actors 個の Actor プロセスを fork し、このプロセスを Learner にする.
+
+    :type agent_player: AsciiGamePlayerAgent
+    """
+    from ascii_game_player_agent import QuitGameException
+
+    model = agent_player.agent_model
+    queues = [SharedTransitionQueue(queue_capacity, game_class.HEIGHT, game_class.WIDTH) for _ in range(num_actors)]
+    shared_parameters = SharedParameters(model.function_set)
+    actors = []
+    for actor_id in range(num_actors):
+        p = multiprocessing.Process(target=actor_main,
+                                    args=(actor_id, game_class, agent_player, queues[actor_id], shared_parameters,
+                                          base_seed))
+        p.daemon = True
+        p.start()
+        actors.append(p)
+
+    learner = FleetLearner(agent_player, queues, shared_parameters)
+    try:
+        while True:
+            try:
+                learner.learn_forever()
+            except QuitGameException as e:
+                agent_player.load_model_parameters()
+                shared_parameters.publish(model.function_set)
+                print e
+    finally:
+        agent_player.shutdown()
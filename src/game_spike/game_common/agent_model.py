@@ -8,11 +8,19 @@ import numpy as np
 from chainer import cuda, Function, FunctionSet, gradient_check, Variable, optimizers
 import chainer.functions as F
 
+from layer_pipeline import LayerPipeline
+
 class AgentModel(object):
     meta = {}
     activate_functions = {}
 
-    def __init__(self, model, model_name, width, height, history_size, out_size):
+    def __init__(self, model, model_name, width, height, history_size, out_size, action_codes=None):
+        """
+
+        :param action_codes: 出力の i 番目がどのキーコードの Q値か. None なら i 番目がキーコード i (out_size=64)
+        """
+        self.meta = {}
+        self.activate_functions = {}
         self.function_set = model
         self.model_name = model_name or ('created_%s' % datetime.datetime.now().strftime('%Y%m%d_%H%M%S'))
         self.width = width
@@ -20,24 +28,41 @@ class AgentModel(object):
         self.history_size = history_size
         self.in_size = width * height * self.history_size
         self.out_size = out_size
+        self.action_codes = list(action_codes) if action_codes is not None else range(out_size)
         self.meta['name'] = self.model_name
-
-    def forward(self, in_variable, train=True):
-        x = in_variable
-        y = None
-        for i in range(1, 1000):  # 1000 は適当な数
-            name = "l%d" % i
-            if hasattr(self.function_set, name):
-                li = getattr(self.function_set, name)
-                if self.activate_functions.get(name):
-                    func = self.activate_functions.get(name)
-                    x = func(li(x), train=train)
-                else:
-                    x = li(x)
-            else:
-                y = x
-                break
-        return y
+        self.pipeline = None
+
+    def compile(self):
+        """
+        activate_functions を決めた後に呼んで、forward で使う LayerPipeline を作る(作り直す).
+        呼ばなくても最初の forward で作られる.
+        """
+        if self.pipeline is None:
+            self.pipeline = LayerPipeline(self.function_set, self.activate_functions)
+        else:
+            self.pipeline.activate_functions = self.activate_functions
+            self.pipeline.compile()
+        return self.pipeline
+
+    def forward(self, in_variable, train=True, function_set=None):
+        """
+        :param function_set: 同じ形の別の重み(target network など)で計算する時に指定する
+        """
+        pipeline = self.pipeline or self.compile()
+        return pipeline(in_variable, train=train, function_set=function_set)
+
+    def adapt_parameters(self, parameters):
+        """
+        保存されていた parameters を今のモデルの形に合わせる.
+        64 個全部のキーコードの出力を持つ古いモデルなら、最後の層を action_codes の分だけにする.
+        """
+        adapted = []
+        for saved, current in zip(parameters, self.function_set.parameters):
+            if saved.shape != current.shape and saved.shape[1:] == current.shape[1:] \
+                    and saved.shape[0] > max(self.action_codes) and current.shape[0] == len(self.action_codes):
+                saved = saved[self.action_codes]
+            adapted.append(saved)
+        return tuple(adapted)
 
     def get_extra_params(self):
         return []
@@ -46,7 +71,10 @@ class AgentModel(object):
         pass
 
     def convert_state_to_input(self, state):
-        return ((state.screen.data - 32) / 96.0).astype('float32')
+        return self.convert_screen_to_input(state.screen.data)
+
+    def convert_screen_to_input(self, screen_data):
+        return ((screen_data - 32) / 96.0).astype('float32')
 
     def on_learn(self, times):
         self.meta['learn_times'] = self.meta.get('learn_times', 0) + times
@@ -65,8 +93,8 @@ class EmbedAgentModel(AgentModel):
         self._W = np.random.randn(96, embed_out_size).astype(np.float32)
         self._W[0] = np.zeros([embed_out_size], dtype=np.float32)
 
-    def convert_state_to_input(self, state):
-        return self._W[state.screen.data - 32].reshape(self.height, self.width)
+    def convert_screen_to_input(self, screen_data):
+        return self._W[screen_data - 32].reshape(self.height, self.width)
 
     def get_extra_params(self):
         return [self._W]
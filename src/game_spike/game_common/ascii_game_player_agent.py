@@ -1,39 +1,43 @@
 # coding: utf-8
 __author__ = 'k_morishita'
 
+import copy
 import os
 from random import random, randint, choice
 import math
+import time
 import numpy as np
 from chainer import Variable, optimizers
 
 from game_repository import GameRepository
 from replay_server import ReplayServer
+from phase_profiler import create_profiler
+from replay_memory import ReplayMemory, PrioritizedReplayMemory
+from frame_stack import FrameStack
+from async_learner import AsyncLearner
+from checkpointer import Checkpointer
+from telemetry import RollingStats, Telemetry
+from numpy_inference import NumpyInference
 
 class LossHistory(object):
-    pointer = 0
-    history_ready = False
-
     def __init__(self, size):
-        self.loss_history = None
         self.max_loss_in_a_game = 0
-        self.loss_history_size = size
-        self.reset()
+        self.stats = RollingStats(size)
 
     def ready(self):
         self.max_loss_in_a_game = 0
 
     def reset(self):
-        self.pointer = 0
-        self.loss_history = np.zeros([self.loss_history_size], dtype=np.float32)
-        self.history_ready = False
+        self.stats.reset()
+
+    @property
+    def history_ready(self):
+        return self.stats.count == self.stats.window
 
     def add_loss(self, loss):
-        loss_z = (loss - np.average(self.loss_history)) / np.var(self.loss_history)
-        self.loss_history[self.pointer] = loss
-        self.pointer = (self.pointer + 1) % self.loss_history_size
-        if self.pointer == 0:
-            self.history_ready = True
+        std = self.stats.std
+        loss_z = (loss - self.stats.mean) / std if std > 0 else 0.0
+        self.stats.add(loss)
         self.max_loss_in_a_game = max(self.max_loss_in_a_game, loss)
         return loss_z
 
@@ -44,6 +48,13 @@ class AsciiGamePlayerAgent(object):
     ALPHA = 0.1
     GAMMA = 0.99
     E_GREEDY = 0.3
+    REPLAY_MEMORY_SIZE = 10000  # 0 なら ReplayMemory を使わずに最新の遷移だけで学習する
+    BATCH_SIZE = 32
+    N_STEP = 3  # ReplayMemory から学習する時に何手先までの報酬で target を作るか
+    PRIORITIZED_REPLAY = 1  # 1 なら TD誤差の大きい遷移を優先して取り出す
+    OPTIMIZER_PARAMS = dict(lr=0.00025, alpha=0.95, momentum=0.95, eps=0.0001)  # RMSpropGraves
+    TARGET_UPDATE_INTERVAL = 0  # 0 より大きいと target の計算に、その回数の学習毎に同期する重みのコピーを使う
+    NUMPY_INFERENCE = 1  # 1 なら train=False の forward は NumpyInference で計算する
 
     optimizer = None
 
@@ -53,50 +64,181 @@ class AsciiGamePlayerAgent(object):
 
     last_state = None
     last_action = None
+    episode_id = 0
     training = True
     use_greedy = True
 
-    def __init__(self, agent_model, repo=None):
+    # 現在の state の Q値は1ステップに1回だけ計算する.
+    # history か重みが変わったら(version が変わったら)計算し直す
+    history_version = 0
+    weights_version = 0
+    q_cache_key = None
+    q_cache = None
+
+    async_learner = None  # start_async_learner() すると学習は別スレッドで行う
+    inference = None  # NumpyInference. None なら推論も Chainer で計算する
+
+    def __init__(self, agent_model, repo=None, replay_memory_size=None, batch_size=None,
+                 target_update_interval=None, n_step=None, optimizer_params=None):
         """
 
         :type agent_model: AgentModel
+        :param optimizer_params: OPTIMIZER_PARAMS のうち変えたい物
         """
         self.agent_model = agent_model
-        self.actions = range(self.agent_model.out_size)
+        self.optimizer_params = dict(self.OPTIMIZER_PARAMS, **(optimizer_params or {}))
+        self.actions = self.agent_model.action_codes  # 出力の index -> キーコード
         self.repo = repo or GameRepository()
+        if target_update_interval is None:
+            target_update_interval = int(os.environ.get("TARGET_UPDATE_INTERVAL", self.TARGET_UPDATE_INTERVAL))
+        self.target_update_interval = target_update_interval
+        self.target_function_set = None
+        if target_update_interval > 0:
+            self.target_function_set = copy.deepcopy(agent_model.function_set)
+        self.update_count = 0
+        self.frame_stack = FrameStack(agent_model.history_size+1, agent_model.height, agent_model.width)
+        self.checkpointer = Checkpointer(self.repo, agent_model)
+        self.telemetry = Telemetry(self.repo, agent_model.model_name)
+        if int(os.environ.get("NUMPY_INFERENCE", self.NUMPY_INFERENCE)) and NumpyInference.supports(agent_model):
+            self.inference = NumpyInference(agent_model)
         self.load_model_parameters()
         self.effective_action_index_list = range(len(self.actions))
+        self.action_mask = None  # 出力のうち選んで良い物. None なら全部
         self.loss_history = LossHistory(100)
+        self.debug = is_debug()
+        if replay_memory_size is None:
+            replay_memory_size = int(os.environ.get("REPLAY_MEMORY_SIZE", self.REPLAY_MEMORY_SIZE))
+        self.batch_size = batch_size or int(os.environ.get("BATCH_SIZE", self.BATCH_SIZE))
+        self.n_step = n_step or int(os.environ.get("N_STEP", self.N_STEP))
+        self.replay_memory = None
+        if replay_memory_size > 0:
+            if int(os.environ.get("PRIORITIZED_REPLAY", self.PRIORITIZED_REPLAY)):
+                memory_class = PrioritizedReplayMemory
+            else:
+                memory_class = ReplayMemory
+            self.replay_memory = memory_class(replay_memory_size, agent_model.history_size,
+                                              agent_model.height, agent_model.width)
 
     def load_model_parameters(self):
         self.repo.load_model_params(self.agent_model)
+        if self.inference is not None:
+            self.inference.refresh()  # 重みの配列が入れ替わっている
+        self.on_weights_changed()
+        self.sync_target()
         # self.optimizer = optimizers.SGD()
-        self.optimizer = optimizers.RMSpropGraves(lr=0.00025, alpha=0.95, momentum=0.95, eps=0.0001)
+        self.optimizer = optimizers.RMSpropGraves(**self.optimizer_params)
         self.optimizer.setup(self.agent_model.function_set.collect_parameters())
 
     def ready(self):
         self.last_action = None
+        self.episode_id += 1
         self.loss_history.ready()
-        self.state_history_array = np.zeros([self.agent_model.history_size+1, self.agent_model.height, self.agent_model.width],
-                                     dtype=np.float32)
+        self.frame_stack.reset()
+        self.state_history_array = self.frame_stack.history
 
-    def action(self, state, last_reward):
+    def set_action_space(self, action_space):
+        """
+        ゲームの ACTION_SPACE を渡す. action_space.mask で無効なキーコードの出力は選ばないようにする.
+        effective_action_index_list と action_mask は action_space.mask を出力の並び(self.actions)で見た物.
+
+        :type action_space: ActionSpace
+        """
+        mask = action_space.mask[self.actions]
+        self.effective_action_index_list = list(np.flatnonzero(mask))
+        self.action_mask = None if mask.all() else mask
+
+    def max_q(self, q_values):
+        """action_mask を考えた [N, out_size] の Q値の最大値 [N]"""
+        if self.action_mask is None:
+            return np.max(q_values, axis=1)
+        return np.max(q_values[:, self.action_mask], axis=1)
+
+    def start_async_learner(self, publish_interval=None):
+        """これ以降 action() は推論だけ行い、遷移は AsyncLearner の学習スレッドに渡す"""
+        self.async_learner = AsyncLearner(self, publish_interval=publish_interval)
+        self.async_learner.start()
+
+    def on_weights_changed(self):
+        self.weights_version += 1
+
+    def sync_target(self):
+        """target network に今の重みをコピーする"""
+        if self.target_function_set is not None:
+            for dst, src in zip(self.target_function_set.parameters, self.agent_model.function_set.parameters):
+                dst[...] = src
+
+    def on_optimizer_update(self):
+        self.on_weights_changed()
+        self.checkpointer.on_update()
+        self.telemetry.on_update()
+        self.update_count += 1
+        if self.target_function_set is not None and self.update_count % self.target_update_interval == 0:
+            self.sync_target()
+
+    def action(self, state, last_reward, terminal=False):
+        self.telemetry.on_step()
         self.update_history(state)
-        if self.last_action is not None and self.training:
-            self.update_q_table(self.state_history_array, self.last_action, last_reward)
+        # 学習で重みが変わる前に選ぶ. 計算した Q値は学習の target にも使い回す
         next_action = self.select_action(self.state_history_array)
+        if self.last_action is not None and self.training and self.async_learner is not None:
+            self.async_learner.push(self.state_history_array, self.last_action, last_reward, terminal,
+                                    self.episode_id)
+        elif self.last_action is not None and self.training:
+            current_q = None
+            if self.replay_memory is None and self.target_function_set is None and not terminal:
+                current_q = self.current_q_values(self.state_history_array)
+            self.update_q_table(self.state_history_array, self.last_action, last_reward, terminal,
+                                self.episode_id, current_q=current_q)
         self.last_action = next_action
         return self.actions[next_action]
 
     def update_history(self, state):
         in_data = self.agent_model.convert_state_to_input(state)
-        self.state_history_array = np.roll(self.state_history_array, 1, axis=0)  # shift history array: 0->1, 1->2, ...
-        self.state_history_array[0] = in_data                             # set new history to 0
-
-    def forward(self, part_of_history_array, train=True):
+        self.frame_stack.push(in_data)                          # 0 が最新. 1, 2, ... はその前
+        self.state_history_array = self.frame_stack.history     # コピーせずに view を持つ
+        self.history_version += 1
+
+    def current_q_values(self, history_array):
+        """state_history_array の現在の state の Q値 [1, out_size]. 同じ version の間は使い回す"""
+        if self.async_learner is not None:
+            key = (self.history_version, self.async_learner.acting_version)
+        else:
+            key = (self.history_version, self.weights_version)
+        if self.q_cache_key != key:
+            if self.async_learner is not None:
+                self.q_cache = self.async_learner.forward(
+                    lambda function_set: self.infer(history_array[:self.agent_model.history_size],
+                                                    function_set=function_set))
+            else:
+                self.q_cache = self.infer(history_array[:self.agent_model.history_size])
+            self.q_cache_key = key
+            self.telemetry.add("q_max", np.max(self.q_cache))
+        return self.q_cache
+
+    def infer(self, part_of_history_array, function_set=None):
+        """train=False の Q値 [1, out_size]. 学習しないので NumpyInference があればそれで計算する"""
+        if self.inference is None:
+            return self.forward(part_of_history_array, train=False, function_set=function_set).data
+        return self.inference(part_of_history_array.reshape((1, self.agent_model.history_size,
+                                                             self.agent_model.height, self.agent_model.width)),
+                              function_set=function_set)
+
+    def infer_batch(self, history_batch, function_set=None):
+        """train=False の Q値 [N, out_size]"""
+        if self.inference is None:
+            return self.forward_batch(history_batch, train=False, function_set=function_set).data
+        return self.inference(history_batch, function_set=function_set)
+
+    def forward(self, part_of_history_array, train=True, function_set=None):
         x = Variable(part_of_history_array.reshape((1, self.agent_model.history_size,
-                                                   self.agent_model.height, self.agent_model.width)))
-        return self.agent_model.forward(x, train=train)
+                                                   self.agent_model.height, self.agent_model.width)),
+                     volatile=not train)
+        return self.agent_model.forward(x, train=train, function_set=function_set)
+
+    def forward_batch(self, history_batch, train=True, function_set=None):
+        """:param history_batch: [N, history_size, height, width]"""
+        x = Variable(np.ascontiguousarray(history_batch), volatile=not train)
+        return self.agent_model.forward(x, train=train, function_set=function_set)
 
     def forward_last_state(self, history_array, train=True):
         return self.forward(history_array[1:], train=train)
@@ -105,28 +247,87 @@ class AsciiGamePlayerAgent(object):
         return self.forward(history_array[:self.agent_model.history_size], train=train)
 
     def select_action(self, history_array):
-        q_list = self.forward_current_state(history_array, train=False)
         if self.use_greedy and random() < self.E_GREEDY:
             return choice(self.effective_action_index_list)
-        else:
-            return np.argmax(q_list.data)
+        q_values = self.current_q_values(history_array)[0]
+        if self.action_mask is None:
+            return np.argmax(q_values)
+        return self.effective_action_index_list[np.argmax(q_values[self.action_mask])]
+
+    def update_q_table(self, history_array, last_action, last_reward, terminal=False, episode_id=0,
+                       current_q=None):
+        """
+        ReplayMemory があれば遷移を入れて、そこから batch_size 個取り出して1回学習する(n_step 手先までの報酬を使う).
+        無ければ最新の遷移で1回だけ学習する.
 
-    def update_q_table(self, history_array, last_action, last_reward):
-        for loop_num in range(100):
-            loss_value = self.do_update_q_table(history_array, last_action, last_reward)
+        :param episode_id: 同じゲームの遷移には同じ値を渡す
+        :param current_q: 計算済みなら history_array の現在の state の Q値
+        """
+        if self.replay_memory is None:
+            loss_value = self.do_update_q_table(history_array, last_action, last_reward, terminal, current_q)
+            self.on_loss(loss_value, math.sqrt(2 * loss_value))
+        else:
+            self.replay_memory.add(history_array, last_action, last_reward, terminal, episode_id)
+            self.learn_from_replay_memory()
+
+    def learn_from_replay_memory(self):
+        """ReplayMemory から batch_size 個取り出して1回学習する. 溜まっていなければ何もしない"""
+        if len(self.replay_memory) < self.batch_size:
+            return
+        batch = self.replay_memory.sample(self.batch_size, self.n_step, self.GAMMA)
+        loss_value, td_errors = self.do_update_q_table_batch(*batch[1:])
+        indices = batch[0]
+        self.replay_memory.update_priorities(indices, td_errors)
+        self.on_loss(loss_value, np.mean(np.abs(td_errors)))
+
+    def on_loss(self, loss_value, td_error):
+        if math.isnan(loss_value):
+            self.loss_history.reset()
+            raise QuitGameException("loss_value become Nan!")
+        self.telemetry.add("loss", loss_value)
+        self.telemetry.add("td_error", td_error)
+        if self.debug:
             loss_z = self.loss_history.add_loss(loss_value)
-            if is_debug():
-                print "loss=%s\tZ=%s\tmax_loss=%s\tLOOP=%s" % \
-                      (round(loss_value, 6), round(loss_z, 2),
-                       self.loss_history.max_loss_in_a_game, loop_num)
-            if loss_z < 4 or not self.loss_history.history_ready:
-                break
-            if math.isnan(loss_value):
-                self.loss_history.reset()
-                raise QuitGameException("loss_value become Nan!")
-
-    def do_update_q_table(self, history_array, last_action, last_reward):
-        target_val = last_reward + self.GAMMA * np.max(self.forward_current_state(history_array, train=False).data)
+            print "loss=%s\tZ=%s\tmax_loss=%s" % \
+                  (round(loss_value, 6), round(loss_z, 2), self.loss_history.max_loss_in_a_game)
+
+    def do_update_q_table_batch(self, last_states, actions, returns, discounts, next_states, weights):
+        """
+        target = returns + discounts * max Q(next_states) に近づける.
+
+        :param last_states: [N, history_size, height, width]
+        :param weights: importance-sampling weight [N]
+        :return: (weight をかけた平均 loss, TD誤差 [N])
+        """
+        n = len(actions)
+        next_q = self.infer_batch(next_states, function_set=self.target_function_set)
+        target_val = returns + discounts * self.max_q(next_q)
+
+        self.optimizer.zero_grads()
+        last_q_list = self.forward_batch(last_states, train=True)
+        td_errors = target_val - last_q_list.data[np.arange(n), actions]
+        tt = np.copy(last_q_list.data)
+        tt[np.arange(n), actions] = target_val
+        target = Variable(tt)
+        loss = 0.5 * (target - last_q_list) ** 2
+        loss_value = np.mean(weights * loss.data[np.arange(n), actions])
+        # 選んだ action 以外は target と同じ値なので grad は関係ない
+        loss.grad = np.repeat((weights / n).reshape(n, 1), loss.data.shape[1], axis=1)
+        loss.backward()
+        self.optimizer.update()
+        self.on_optimizer_update()
+        self.agent_model.on_learn(times=n)
+        return loss_value, td_errors
+
+    def do_update_q_table(self, history_array, last_action, last_reward, terminal=False, current_q=None):
+        """terminal なら次の state は無いので、target は last_reward だけ(ReplayMemory の discount=0 と同じ)"""
+        if terminal:
+            target_val = last_reward
+        else:
+            if current_q is None:
+                current_q = self.infer(history_array[:self.agent_model.history_size],
+                                       function_set=self.target_function_set)
+            target_val = last_reward + self.GAMMA * self.max_q(current_q)[0]
 
         self.optimizer.zero_grads()
         last_q_list = self.forward_last_state(history_array, train=True)
@@ -138,6 +339,7 @@ class AsciiGamePlayerAgent(object):
         loss.grad = np.array([[1]], dtype=np.float32)
         loss.backward()
         self.optimizer.update()
+        self.on_optimizer_update()
         self.agent_model.on_learn(times=len(tt))
         return loss_value
 
@@ -147,35 +349,117 @@ class AsciiGamePlayerAgent(object):
 
     def on_game_over(self, game):
         # Learn last bad reward
-        self.action(game.state, game.last_reward)
-        if self.training:
-            self.repo.save_model_params(self.agent_model)
-        if is_debug():
+        self.action(game.state, game.last_reward, terminal=True)
+        if self.training and self.async_learner is not None:
+            self.async_learner.on_game_over(game.total_reward)  # snapshot は学習スレッドで取る
+        elif self.training:
+            self.checkpointer.on_game_over(game.total_reward)
+        if self.training:  # 学習しない Actor や評価の Agent が Learner の telemetry に混ざらないようにする
+            self.telemetry.on_episode(game.total_reward)
+            self.telemetry.maybe_write()
+        if self.debug:
             print "max_loss_in_this_game: %s" % self.loss_history.max_loss_in_a_game
 
     def on_update(self, game):
         pass
 
+    def shutdown(self):
+        """終了する前に呼ぶ. 学習していれば最後の重みを保存し、書きかけの checkpoint と telemetry を書き終える"""
+        if self.training and self.async_learner is not None:
+            self.async_learner.request_checkpoint()
+            self.async_learner.stop()
+        elif self.training:
+            self.checkpointer.request()
+        self.checkpointer.flush()
+        self.telemetry.flush()
+
 def is_debug():
     return os.environ.get("DEBUG", None) is not None
 
 def agent_play(game_class, agent_player):
+    if int(os.environ.get("NUM_ACTORS", 0)) > 0:
+        from actor_fleet import fleet_play
+        return fleet_play(game_class, agent_player, int(os.environ["NUM_ACTORS"]))
+    if os.environ.get("HEADLESS", None):
+        return agent_play_headless(game_class, agent_player)
+    if os.environ.get("ASYNC_LEARNER", None):
+        agent_player.start_async_learner()
+
     replay_server = ReplayServer(int(os.environ.get("GAME_SERVER_PORT", 7000)))
 
     game = game_class(agent_player)
+    game.profiler = create_profiler()
     game.add_observer(replay_server)
     game.add_observer(agent_player)
 
     replay_server.run_as_background()
 
-    agent_player.effective_action_index_list = game.effective_actions()
-
-    while True:
-        replay_server.info = ["e-Greedy=%s" % agent_player.use_greedy] + agent_player.agent_model.info_list()
-        try:
-            game.play()
-            if game.play_id % 10 == 0:
-                agent_player.use_greedy = not agent_player.use_greedy
-        except QuitGameException as e:
-            agent_player.load_model_parameters()
-            print e
+    agent_player.set_action_space(game.ACTION_SPACE)
+
+    try:
+        while True:
+            replay_server.info = ["e-Greedy=%s" % agent_player.use_greedy] + agent_player.agent_model.info_list()
+            if agent_player.async_learner is not None:
+                replay_server.info += agent_player.async_learner.info_list()
+            if game.profiler is not None:
+                replay_server.info += game.profiler.info_list()
+            try:
+                game.play()
+                if game.play_id % 10 == 0:
+                    agent_player.use_greedy = not agent_player.use_greedy
+            except QuitGameException as e:
+                agent_player.load_model_parameters()
+                print e
+    finally:
+        agent_player.shutdown()
+
+
+def agent_play_headless(game_class, agent_player):
+    """Observer も ReplayServer も使わずに reset()/step() で回し続ける"""
+    game = game_class(agent_player)
+    game.headless = True
+    game.profiler = create_profiler()
+    agent_player.set_action_space(game.ACTION_SPACE)
+    if os.environ.get("ASYNC_LEARNER", None):
+        agent_player.start_async_learner()
+
+    try:
+        while True:
+            try:
+                play_headless(game, agent_player)
+                if game.play_id % 10 == 0:
+                    agent_player.use_greedy = not agent_player.use_greedy
+            except QuitGameException as e:
+                agent_player.load_model_parameters()
+                print e
+    finally:
+        agent_player.shutdown()
+
+
+def play_headless(game, agent_player):
+    """
+    1ゲーム分を headless で進める. Observer 通知の代わりに agent の on_game_start/on_game_over を直接呼ぶ.
+
+    :type game: AsciiGame
+    :type agent_player: AsciiGamePlayerAgent
+    """
+    state = game.reset()
+    agent_player.on_game_start(game)
+    reward = 0
+    is_game_over = False
+    profiler = game.profiler
+    while not is_game_over:
+        if profiler is None:
+            action = agent_player.action(state, reward)
+        else:
+            t = time.time()
+            action = agent_player.action(state, reward)
+            profiler.add("player.action", t)
+        state, reward, is_game_over, _ = game.step(action)
+    if profiler is None:
+        agent_player.on_game_over(game)
+    else:
+        t = time.time()
+        agent_player.on_game_over(game)
+        profiler.add("player.on_game_over", t)
+        profiler.end_episode(game)
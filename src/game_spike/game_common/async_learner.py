@@ -0,0 +1,167 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+"""
+行動(推論)と学習を別スレッドに分ける.
+ゲーム側のスレッドは acting 用の重みのコピーで行動を選んで遷移を queue に入れるだけにして、
+学習スレッドが queue から取り出して学習し、PUBLISH_INTERVAL 回毎に acting 用の重みを更新する.
+ReplayMemory がある時は、遷移が来るのを待たずに ReplayMemory から minibatch を取り出して学習し続ける.
+checkpoint の snapshot も学習スレッドで取るので、ゲーム側のスレッドは学習を待たない.
+"""
+
+import copy
+import os
+import Queue
+import threading
+
+
+class AsyncLearner(object):
+    PUBLISH_INTERVAL = 100  # 何回学習したら acting 用の重みを更新するか
+    QUEUE_SIZE = 1000       # 学習が追いつかない時はこれより古い遷移を捨てる
+    UPDATES_PER_TRANSITION = 1.0  # 受け取った遷移1つ当たり何回まで学習するか. 0 なら制限しない
+    IDLE_WAIT = 0.1  # 学習できない時に遷移や checkpoint の依頼を待つ秒数
+
+    def __init__(self, agent_player, publish_interval=None, queue_size=None, updates_per_transition=None):
+        """
+
+        :type agent_player: AsciiGamePlayerAgent
+        """
+        self.agent_player = agent_player
+        self.publish_interval = publish_interval or int(os.environ.get("ASYNC_PUBLISH_INTERVAL",
+                                                                       self.PUBLISH_INTERVAL))
+        if updates_per_transition is None:
+            updates_per_transition = float(os.environ.get("ASYNC_UPDATES_PER_TRANSITION",
+                                                          self.UPDATES_PER_TRANSITION))
+        self.updates_per_transition = updates_per_transition
+        self.queue = Queue.Queue(queue_size or self.QUEUE_SIZE)
+        self.checkpoint_queue = Queue.Queue()  # ゲーム側からの checkpoint の依頼. 学習スレッドが処理する
+        self.lock = threading.Lock()          # 学習中の重み(agent_model.function_set)を守る
+        self.publish_lock = threading.Lock()  # acting 用の重みを守る
+        self.acting_function_set = copy.deepcopy(agent_player.agent_model.function_set)
+        self.acting_version = 0
+        self.learn_count = 0
+        self.transition_count = 0
+        self.dropped_count = 0
+        self.last_episode_id = None
+        self.segment_id = 0  # 捨てずに続いている遷移の並び毎の番号. ReplayMemory にはこれを episode_id として渡す
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.thread = threading.Thread(target=self.learn_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def push(self, history_array, last_action, last_reward, terminal, episode_id):
+        """
+        ゲーム側から呼ぶ. 待たずに返る.
+        queue が一杯で捨てた時は、その後の遷移を別の episode_id にして n-step の報酬和が抜けた所をまたがないようにする.
+        """
+        if episode_id != self.last_episode_id:
+            self.last_episode_id = episode_id
+            self.segment_id += 1
+        try:
+            self.queue.put_nowait((history_array.copy(), last_action, last_reward, terminal, self.segment_id))
+        except Queue.Full:
+            self.dropped_count += 1
+            self.segment_id += 1
+
+    def on_game_over(self, score):
+        """ゲーム側から呼ぶ. 待たずに返る. checkpointer.on_game_over(score) は学習スレッドで呼ぶ"""
+        self.checkpoint_queue.put(("game_over", score))
+
+    def request_checkpoint(self):
+        """ゲーム側から呼ぶ. 学習スレッドが今の重みの snapshot を checkpointer に渡すまで待つ(学習スレッドが止まっていれば待たない)"""
+        done = threading.Event()
+        self.checkpoint_queue.put(("request", done))
+        while not done.is_set() and self.thread is not None and self.thread.is_alive():
+            done.wait(self.IDLE_WAIT)
+
+    def stop(self):
+        """学習スレッドを止めて終わるまで待つ"""
+        if self.thread is not None:
+            self.checkpoint_queue.put(("stop", None))
+            self.thread.join()
+            self.thread = None
+
+    def learn_forever(self):
+        from ascii_game_player_agent import QuitGameException
+        self.running = True
+        while self.running:
+            transitions = self.get_transitions(block=not self.can_learn_from_replay_memory())
+            with self.lock:
+                try:
+                    self.learn(transitions)
+                except QuitGameException as e:
+                    self.agent_player.load_model_parameters()
+                    self.publish()
+                    print e
+                self.process_checkpoint_queue()
+
+    def can_learn_from_replay_memory(self):
+        replay_memory = self.agent_player.replay_memory
+        if replay_memory is None or len(replay_memory) < self.agent_player.batch_size:
+            return False
+        return not self.updates_per_transition or \
+            self.learn_count < self.updates_per_transition * self.transition_count
+
+    def get_transitions(self, block):
+        """溜まっている遷移を全部取り出す. block なら IDLE_WAIT 秒までは1つ来るのを待つ"""
+        transitions = []
+        if block:
+            try:
+                transitions.append(self.queue.get(timeout=self.IDLE_WAIT))
+            except Queue.Empty:
+                return transitions
+        while not self.queue.empty():
+            transitions.append(self.queue.get_nowait())
+        return transitions
+
+    def learn(self, transitions):
+        agent = self.agent_player
+        self.transition_count += len(transitions)
+        if agent.replay_memory is None:
+            for transition in transitions:
+                agent.update_q_table(*transition)
+                self.on_learn()
+        else:
+            # 来た分は ReplayMemory に入れるだけにして、学習は ReplayMemory から1回ずつ
+            for transition in transitions:
+                agent.replay_memory.add(*transition)
+            if self.can_learn_from_replay_memory():
+                agent.learn_from_replay_memory()
+                self.on_learn()
+
+    def on_learn(self):
+        self.learn_count += 1
+        if self.learn_count % self.publish_interval == 0:
+            self.publish()
+
+    def process_checkpoint_queue(self):
+        checkpointer = self.agent_player.checkpointer
+        while not self.checkpoint_queue.empty():
+            kind, value = self.checkpoint_queue.get_nowait()
+            if kind == "game_over":
+                checkpointer.on_game_over(value)
+            elif kind == "stop":
+                self.running = False
+            else:
+                checkpointer.request()
+                value.set()
+
+    def publish(self):
+        with self.publish_lock:
+            for dst, src in zip(self.acting_function_set.parameters,
+                                self.agent_player.agent_model.function_set.parameters):
+                dst[...] = src
+            self.acting_version += 1
+
+    def forward(self, forward_func):
+        """acting 用の重みで forward_func(function_set) を呼ぶ"""
+        with self.publish_lock:
+            return forward_func(self.acting_function_set)
+
+    def info_list(self):
+        return [
+            "Queue=%s Dropped=%s Learned=%s" % (self.queue.qsize(), self.dropped_count, self.learn_count),
+        ]
@@ -5,6 +5,8 @@ __author__ = 'k_morishita'
 
 import numpy as np
 import copy
+import itertools
+import time
 
 class Game(object):
     observers = []
@@ -16,6 +18,8 @@ class Game(object):
     is_game_over = None
     last_action = None
     high_score = -10000
+    headless = False  # True なら Observer への通知を全て省く
+    profiler = None   # PhaseProfiler を入れるとフェーズ毎の時間を計る
 
     def __init__(self, player):
         self.player = player
@@ -29,28 +33,67 @@ class Game(object):
         self.is_game_over = False
         self.play_id += 1
         self.prepare_game()
-        self.notify_game_start()
+        if not self.headless:
+            self.notify_game_start()
 
     def player_action(self):
-        action = self.player.action(self.state, self.last_reward)
-        if not self.is_valid_action(action):
-            action = None
-        self.state, self.last_reward = self.get_next_state_and_reward(self.state, action)
-        self.last_action = action
+        if self.profiler is None:
+            self.step(self.player.action(self.state, self.last_reward))
+        else:
+            t = time.time()
+            action = self.player.action(self.state, self.last_reward)
+            self.profiler.add("player.action", t)
+            self.step(action)
 
     def game_over(self):
-        self.notify_game_over()
+        if not self.headless:
+            self.notify_game_over()
+        if self.high_score < self.total_reward:
+            self.high_score = self.total_reward
+        if self.profiler is not None and not self.headless:
+            # headless の時は Agent の on_game_over を呼ぶ側(play_headless)が測ってから end_episode する
+            self.profiler.end_episode(self)
 
     def play(self):
         self.game_start()
         while not self.is_game_over:
-            self.turn += 1
             self.player_action()
-            self.total_reward += self.last_reward
+
+    def reset(self):
+        """
+        ゲームを開始して最初の state を返す.
+
+        :return: state
+        """
+        self.game_start()
+        return self.state
+
+    def step(self, action):
+        """
+        1ターン進める. ゲームオーバーになったら game_over() まで行う.
+
+        :return: (state, reward, is_game_over, info)
+                 headless の時は info は空の dict
+        """
+        self.turn += 1
+        if not self.is_valid_action(action):
+            action = None
+        if self.profiler is None:
+            self.state, self.last_reward = self.get_next_state_and_reward(self.state, action)
+        else:
+            t = time.time()
+            self.state, self.last_reward = self.get_next_state_and_reward(self.state, action)
+            self.profiler.add("game.step", t)
+        self.last_action = action
+        self.total_reward += self.last_reward
+        if self.headless:
+            info = {}
+        else:
             self.notify_update()
-        self.game_over()
-        if self.high_score < self.total_reward:
-            self.high_score = self.total_reward
+            info = self.turn_info()
+        if self.is_game_over:
+            self.game_over()
+        return self.state, self.last_reward, self.is_game_over, info
 
     def turn_info(self):
         return {
@@ -69,6 +112,41 @@ class Game(object):
     def prepare_game(self):
         raise NotImplemented()
 
+    def set_seed(self, seed):
+        """次の game_start() 以降のゲームの乱数を seed で決める. 乱数を使わないゲームは何もしない"""
+        pass
+
+    ###################
+    # Snapshot
+    ###################
+    SNAPSHOT_HEADER_SIZE = 5
+
+    def snapshot(self):
+        """
+        ゲームの状態(turn, 得点, state)を1本の float64 配列にする.
+        copy.deepcopy よりずっと安いので、途中から何度も分岐させたい時に使う.
+        """
+        header = [self.turn, self.last_reward, self.total_reward, self.is_game_over,
+                  -1 if self.last_action is None else self.last_action]
+        return np.concatenate([np.array(header, dtype=np.float64), self.pack_state(self.state)])
+
+    def restore(self, snapshot):
+        """
+        snapshot() した状態に戻す. state はその場で書き換える(reset() 済みである事).
+        """
+        self.turn = int(snapshot[0])
+        self.last_reward = snapshot[1]
+        self.total_reward = snapshot[2]
+        self.is_game_over = bool(snapshot[3])
+        self.last_action = None if snapshot[4] < 0 else int(snapshot[4])
+        self.unpack_state(self.state, snapshot[self.SNAPSHOT_HEADER_SIZE:])
+
+    def pack_state(self, state):
+        raise NotImplemented()
+
+    def unpack_state(self, state, values):
+        raise NotImplemented()
+
     def is_valid_action(self, action):
         return True
 
@@ -85,20 +163,37 @@ class Game(object):
         self.observers.remove(observer)
 
     def notify_game_start(self):
+        if self.profiler is not None:
+            return self.notify_with_profile("on_game_start")
         for o in self.observers:
             o.on_game_start(self)
 
     def notify_game_over(self):
+        if self.profiler is not None:
+            return self.notify_with_profile("on_game_over")
         for o in self.observers:
             o.on_game_over(self)
 
     def notify_update(self):
+        if self.profiler is not None:
+            return self.notify_with_profile("on_update")
         for o in self.observers:
             o.on_update(self)
 
+    def notify_with_profile(self, event):
+        for o in self.observers:
+            t = time.time()
+            getattr(o, event)(self)
+            self.profiler.add("%s.%s" % (o.__class__.__name__, event), t)
+
 
 class Screen(object):
-    data = []
+    """
+    scroll_x/scroll_y はコピーせずに offset をずらすだけのリングバッファ.
+    data を読んだ時に初めて並べ直した配列を作る(そのまま次のバッファになる).
+    """
+    offset_x = 0
+    offset_y = 0
 
     def __init__(self, width, height):
         self.width = width
@@ -108,24 +203,108 @@ class Screen(object):
     def init_screen(self):
         self.data = np.zeros([self.height, self.width], dtype=np.int8)
 
+    @property
+    def data(self):
+        if self.offset_x or self.offset_y:
+            self._buf = self.unrolled()
+            self.offset_x = self.offset_y = 0
+        return self._buf
+
+    def unrolled(self):
+        """offset の分だけ回した配列を、ずれていない軸には触らずに1回のコピーで作る"""
+        src = self._buf
+        dst = np.empty_like(src)
+        h, w = src.shape
+        oy, ox = self.offset_y, self.offset_x
+        dst[:h-oy, :w-ox] = src[oy:, ox:]
+        if ox:
+            dst[:h-oy, w-ox:] = src[oy:, :ox]
+        if oy:
+            dst[h-oy:, :w-ox] = src[:oy, ox:]
+        if ox and oy:
+            dst[h-oy:, w-ox:] = src[:oy, :ox]
+        return dst
+
+    @data.setter
+    def data(self, data):
+        self._buf = data
+        self.offset_x = self.offset_y = 0
+
     def fill(self, ch):
-        self.data.fill(ch)
+        self._buf.fill(ch)
+        self.offset_x = self.offset_y = 0
 
     def as_float32(self):
         return self.data.astype(np.float32)
 
     def __setitem__(self, key, value):
-        self.data[key] = value
+        p_key = self.physical_key(key)
+        if p_key is None:
+            self.data[key] = value
+        else:
+            self._buf[p_key] = value
 
     def __getitem__(self, item):
-        return self.data[item]
+        p_key = self.physical_key(item)
+        if p_key is None:
+            return self.data[item]
+        return self._buf[p_key]
+
+    def physical_key(self, key):
+        """
+        画面上の座標 (y, x) をバッファ上の index に変換する. それ以外の形の key なら None
+        (行や slice は data を並べ直してから引くので、今まで通り view が返る)
+        """
+        if not (self.offset_x or self.offset_y):
+            return key
+        if isinstance(key, tuple) and len(key) == 2 and \
+                isinstance(key[0], (int, np.integer)) and isinstance(key[1], (int, np.integer)):
+            return (key[0] + self.offset_y) % self.height, (key[1] + self.offset_x) % self.width
+        return None
 
     def scroll_x(self, shift):
-        self.data = np.roll(self.data, shift, axis=1)
+        self.offset_x = (self.offset_x - shift) % self.width
 
     def scroll_y(self, shift):
-        self.data = np.roll(self.data, shift, axis=0)
-
+        self.offset_y = (self.offset_y - shift) % self.height
+
+
+class ActionSpace(object):
+    """
+    キーコード(0〜63)についての表を最初に1回だけ作っておく.
+
+    * actions: 有効な action の list
+    * mask: [64] bool. 有効な action なら True
+    * key_flags: [64, len(KEY_NAMES)] bool. その action でキーが押されているか
+    * key_tuples: key_flags の各行を tuple にしたもの(1つずつ見る時はこちらが速い)
+    """
+    NUM_CODES = 64
+    KEY_NAMES = ("LEFT", "RIGHT", "UP", "DOWN", "A", "B")
+    KEY_LABELS = ("Left", "Right", "Up", "Down", "A", "B")  # 表示用
+
+    def __init__(self, keymap, key_combinations=None):
+        """
+
+        :param keymap: {"UP": キーコード, ...}
+        :param key_combinations: 同時に押せるキーの組み合わせ. 例: [(0, A), (0, LEFT, RIGHT)]
+                                 None なら全てのキーコードが有効
+        """
+        if key_combinations is None:
+            self.actions = range(self.NUM_CODES)
+        else:
+            self.actions = sorted(set(reduce(lambda t, x: t | x, key_code_list)
+                                      for key_code_list in itertools.product(*key_combinations)))
+        self.mask = np.zeros([self.NUM_CODES], dtype=np.bool_)
+        self.mask[self.actions] = True
+        self.key_flags = np.array([[code & keymap[name] != 0 for name in self.KEY_NAMES]
+                                   for code in range(self.NUM_CODES)], dtype=np.bool_)
+        self.key_tuples = [tuple(flags) for flags in self.key_flags.tolist()]
+
+    def contains(self, action):
+        return action is not None and self.mask[action]
+
+    def key_index(self, name):
+        return self.KEY_NAMES.index(name)
 
 
 class AsciiGame(Game):
@@ -137,20 +316,47 @@ class AsciiGame(Game):
     KEY_LEFT = 1 << 3
     BUTTON_A = 1 << 4
     BUTTON_B = 1 << 5
+    KEYMAP = {
+        "UP": KEY_UP,
+        "DOWN": KEY_DOWN,
+        "RIGHT": KEY_RIGHT,
+        "LEFT": KEY_LEFT,
+        "A": BUTTON_A,
+        "B": BUTTON_B,
+    }
+    ACTION_SPACE = ActionSpace(KEYMAP)  # サブクラスで有効なキーの組み合わせを指定する
 
     def is_valid_action(self, action):
         return 0 <= int(action) < 64
 
+    def pack_state(self, state):
+        entities = np.array(self.pack_entities(state), dtype=np.float64)
+        return np.concatenate([entities, state.screen.data.ravel()])
+
+    def unpack_state(self, state, values):
+        screen_size = self.WIDTH * self.HEIGHT
+        self.unpack_entities(state, values[:-screen_size])
+        state.screen.data[...] = values[-screen_size:].reshape(self.HEIGHT, self.WIDTH)
+
+    def pack_entities(self, state):
+        """screen 以外の state を数値の list にする"""
+        raise NotImplemented()
+
+    def unpack_entities(self, state, values):
+        raise NotImplemented()
+
+    def effective_actions(self):
+        return self.ACTION_SPACE.actions
+
+    def pressed_keys(self, action):
+        """
+        :return: (LEFT, RIGHT, UP, DOWN, A, B) の押されているかどうか. action が None なら何も押していない
+        """
+        return self.ACTION_SPACE.key_tuples[action or 0]
+
     def meta_info(self):
         info = super(AsciiGame, self).meta_info()
-        info["keymap"] = {
-            "UP": self.KEY_UP,
-            "DOWN": self.KEY_DOWN,
-            "RIGHT": self.KEY_RIGHT,
-            "LEFT": self.KEY_LEFT,
-            "A": self.BUTTON_A,
-            "B": self.BUTTON_B,
-        }
+        info["keymap"] = dict(self.KEYMAP)
         return info
 
 class StateBase(object):
@@ -0,0 +1,107 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import os
+import threading
+import time
+
+
+class Checkpointer(object):
+    """
+    モデルの保存を書き込み用のスレッドで行う.
+    request() は重みをコピーするだけで返り、pickle とファイル書き込みは書き込みスレッドが行う.
+    書き込みが追いつかない時は、まだ書いていない古い snapshot は捨てて最新の物だけを書く.
+    書き込みスレッドは最初の request() の時に作り、flush() で書き終えたら止める.
+
+    いつ保存するか:
+      * every_updates: 学習 N 回毎 (0 なら無し)
+      * every_seconds: 前回から T 秒以上経ったゲームの終わり (0 なら無し)
+      * on_best_score: ゲームの得点が今までで一番良かった時
+    """
+    EVERY_UPDATES = 0
+    EVERY_SECONDS = 30
+    ON_BEST_SCORE = 1
+
+    def __init__(self, repo, agent_model, every_updates=None, every_seconds=None, on_best_score=None):
+        """
+
+        :type repo: GameRepository
+        :type agent_model: AgentModel
+        """
+        self.repo = repo
+        self.agent_model = agent_model
+        self.every_updates = self.config(every_updates, "CHECKPOINT_EVERY_UPDATES", self.EVERY_UPDATES)
+        self.every_seconds = self.config(every_seconds, "CHECKPOINT_EVERY_SECONDS", self.EVERY_SECONDS)
+        self.on_best_score = self.config(on_best_score, "CHECKPOINT_ON_BEST_SCORE", self.ON_BEST_SCORE)
+        self.update_count = 0
+        self.last_request_time = time.time()
+        self.best_score = None
+        self.pending = None
+        self.stopping = False
+        self.thread = None
+        self.saved_count = 0
+        self.condition = threading.Condition()
+
+    @staticmethod
+    def config(value, env_name, default):
+        if value is not None:
+            return value
+        return type(default)(os.environ.get(env_name, default))
+
+    def on_update(self):
+        self.update_count += 1
+        if self.every_updates and self.update_count % self.every_updates == 0:
+            self.request()
+
+    def on_game_over(self, score=None):
+        if self.on_best_score and score is not None and (self.best_score is None or self.best_score < score):
+            self.best_score = score
+            self.request()
+        elif self.every_seconds and time.time() - self.last_request_time >= self.every_seconds:
+            self.request()
+
+    def request(self):
+        """今の重みの snapshot を取って書き込みスレッドに渡す"""
+        data = self.repo.model_data(self.agent_model)
+        snapshot = {
+            "parameters": [p.copy() for p in data["parameters"]],
+            "extra_params": [p.copy() for p in data["extra_params"]],
+            "meta": dict(data["meta"]),
+        }
+        self.last_request_time = time.time()
+        with self.condition:
+            self.pending = snapshot
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.write_forever)
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def flush(self):
+        """まだ書いていない snapshot があれば書き終わるまで待ち、書き込みスレッドを止める"""
+        with self.condition:
+            thread = self.thread
+            if thread is None:
+                return
+            self.stopping = True
+            self.condition.notify_all()
+        thread.join()
+
+    def write_forever(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.stopping:
+                    self.condition.wait()
+                if self.pending is None:  # flush() された. 次の request() でまた作る
+                    self.stopping = False
+                    self.thread = None
+                    return
+                snapshot, self.pending = self.pending, None
+            try:
+                self.repo.save_model_data(self.agent_model.model_name, snapshot)
+            except Exception:
+                with self.condition:  # 次の request() で書き込みスレッドを作り直す
+                    self.stopping = False
+                    self.thread = None
+                raise
+            self.saved_count += 1
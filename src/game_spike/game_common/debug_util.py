@@ -4,6 +4,7 @@
 __author__ = 'k_morishita'
 
 from curse_util import ignore_error_add_str
+from base_system import ActionSpace
 import time
 import curses
 
@@ -81,10 +82,6 @@ class ConsoleDebugObserver(object):
         self.info_window.addstr(2 , 2, "Total Score: %s" % game.total_reward)
         self.info_window.addstr(3 , 2, "This Reward: %s" % game.last_reward)
         self.info_window.addstr(4 , 2, "=== Action ===")
-        self.info_window.addstr(5 , 2, "Left : %d" % (game.KEY_LEFT  & game.last_action > 0))
-        self.info_window.addstr(6 , 2, "Right: %d" % (game.KEY_RIGHT & game.last_action > 0))
-        self.info_window.addstr(7 , 2, "Up   : %d" % (game.KEY_UP    & game.last_action > 0))
-        self.info_window.addstr(8 , 2, "Down : %d" % (game.KEY_DOWN  & game.last_action > 0))
-        self.info_window.addstr(9 , 2, "A    : %d" % (game.BUTTON_A  & game.last_action > 0))
-        self.info_window.addstr(10, 2, "B    : %d" % (game.BUTTON_B  & game.last_action > 0))
+        for i, pressed in enumerate(game.pressed_keys(game.last_action)):
+            self.info_window.addstr(5+i, 2, "%-5s: %d" % (ActionSpace.KEY_LABELS[i], pressed))
         self.info_window.refresh()
@@ -0,0 +1,33 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import numpy as np
+
+
+class FrameStack(object):
+    """
+    直近 size 枚の画面を新しい順に並べた [size, height, width] の配列を np.roll せずに作る.
+
+    同じ frame を buffer の p と p+size の2箇所に書いておくと、
+    buffer[p:p+size] がいつも新しい順に並んだ連続した view になる.
+    (history[0] が最新. 次の push() で中身が変わるので、取っておく場合は copy すること)
+    """
+
+    def __init__(self, size, height, width, dtype=np.float32):
+        self.size = size
+        self.buffer = np.zeros([2 * size, height, width], dtype=dtype)
+        self.pointer = 0
+
+    def reset(self):
+        self.buffer.fill(0)
+        self.pointer = 0
+
+    def push(self, frame):
+        p = (self.pointer - 1) % self.size
+        self.buffer[p] = frame
+        self.buffer[p + self.size] = frame
+        self.pointer = p
+
+    @property
+    def history(self):
+        return self.buffer[self.pointer:self.pointer + self.size]
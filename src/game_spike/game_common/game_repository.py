@@ -12,9 +12,11 @@ class GameRepository(object):
         self.base_dir = os.path.abspath(base_dir or os.path.expanduser("~/.game"))
         self.model_dir = "%s/model" % self.base_dir
         self.play_data_dir = "%s/play_data" % self.base_dir
+        self.telemetry_dir = "%s/telemetry" % self.base_dir
         self.safe_create_dir(self.base_dir)
         self.safe_create_dir(self.model_dir)
         self.safe_create_dir(self.play_data_dir)
+        self.safe_create_dir(self.telemetry_dir)
 
     @staticmethod
     def safe_create_dir(base_dir):
@@ -24,6 +26,9 @@ class GameRepository(object):
     def get_model_path(self, model_name):
         return "%s/%s.pkl" % (self.model_dir, model_name)
 
+    def get_telemetry_path(self, model_name):
+        return "%s/%s.jsonl" % (self.telemetry_dir, model_name)
+
     def load_model_params(self, agent_model):
         """
 
@@ -33,7 +38,7 @@ class GameRepository(object):
         if os.path.exists(model_path):
             with file(model_path, "rb") as f:
                 data = pickle.load(f)
-                agent_model.function_set.parameters = data["parameters"]
+                agent_model.function_set.parameters = agent_model.adapt_parameters(data["parameters"])
                 agent_model.set_extra_params(data.get("extra_params"))
                 agent_model.meta = data["meta"]
 
@@ -42,12 +47,19 @@ class GameRepository(object):
 
         :type agent_model: AgentModel
         """
-        model_path = self.get_model_path(agent_model.model_name)
+        self.save_model_data(agent_model.model_name, self.model_data(agent_model))
+
+    @staticmethod
+    def model_data(agent_model):
+        return {
+            "parameters": agent_model.function_set.parameters,
+            "extra_params": agent_model.get_extra_params(),
+            "meta": agent_model.meta,
+        }
+
+    def save_model_data(self, model_name, data):
+        """model_data() の形の data を .tmp に書いてから rename する"""
+        model_path = self.get_model_path(model_name)
         with file("%s.tmp" % model_path, "wb") as f:
-            data = {
-                "parameters": agent_model.function_set.parameters,
-                "extra_params": agent_model.get_extra_params(),
-                "meta": agent_model.meta,
-            }
             pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
         os.rename("%s.tmp" % model_path, model_path)
@@ -0,0 +1,68 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+
+def layer_names(function_set):
+    """FunctionSet の l1, l2, ... を順に並べる(途中で抜けている番号があればそこまで)"""
+    names = []
+    while hasattr(function_set, "l%d" % (len(names) + 1)):
+        names.append("l%d" % (len(names) + 1))
+    return names
+
+
+class LayerPipeline(object):
+    """
+    FunctionSet の l1, l2, ... に順に通す計算.
+    hasattr で層を探したり activate_functions を引いたりするのは compile() の時に1回だけやり、
+    __call__ では (層, 活性化関数) のリストを回すだけにする.
+
+    同じ形の別の FunctionSet(target network など)を渡された時は、その FunctionSet 用のリストを作って覚えておく.
+    hook(name, y) を add_hook しておくと、各層(活性化関数の後)の出力を渡して呼ぶ.
+    """
+
+    def __init__(self, function_set, activate_functions=None):
+        self.function_set = function_set
+        self.activate_functions = activate_functions or {}
+        self.hooks = []
+        self.compile()
+
+    def compile(self):
+        """activate_functions を変えたら呼び直す"""
+        self.names = layer_names(self.function_set)
+        self.activations = [self.activate_functions.get(name) for name in self.names]
+        self.compiled = {}
+        self.steps = self.steps_for(self.function_set)
+        return self
+
+    def steps_for(self, function_set):
+        entry = self.compiled.get(id(function_set))
+        if entry is None or entry[0] is not function_set:
+            entry = (function_set, [(getattr(function_set, name), activation)
+                                    for name, activation in zip(self.names, self.activations)])
+            self.compiled[id(function_set)] = entry
+        return entry[1]
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def __call__(self, x, train=True, function_set=None):
+        steps = self.steps if function_set is None else self.steps_for(function_set)
+        if self.hooks:
+            return self.call_with_hooks(steps, x, train)
+        for layer, activation in steps:
+            x = layer(x)
+            if activation is not None:
+                x = activation(x, train=train)
+        return x
+
+    def call_with_hooks(self, steps, x, train):
+        for name, (layer, activation) in zip(self.names, steps):
+            x = layer(x)
+            if activation is not None:
+                x = activation(x, train=train)
+            for hook in self.hooks:
+                hook(name, x)
+        return x
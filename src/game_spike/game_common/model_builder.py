@@ -0,0 +1,77 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+from chainer import FunctionSet
+import chainer.functions as F
+
+from agent_model import EmbedAgentModel
+from numpy_inference import numpy_identity, numpy_relu
+
+
+def calc_output_size(screen_size, ksize, stride):
+    return (screen_size - ksize) / stride + 1
+
+
+def relu_with_drop_ratio(ratio):
+    def f(x, train=True):
+        return F.dropout(F.relu(x), train=train, ratio=ratio)
+    f.numpy_function = numpy_relu  # train=False の時の NumPy 版 (NumpyInference が使う)
+    return f
+
+
+def drop_ratio(ratio):
+    def f(x, train=True):
+        return F.dropout(x, train=train, ratio=ratio)
+    f.numpy_function = numpy_identity
+    return f
+
+
+PTN1_PARAMS = dict(
+    history_size=3,
+    embed_out_size=3,
+    pattern_size1=50,
+    pattern_size2=100,
+    hidden_size=1000,
+    drop_ratios=(0.2, 0.4, 0.5, 0.7),
+)
+
+
+def build_ptn1_model(ThisGame, model_name, **params):
+    """
+    EmbedID + Conv x2 + Linear x2 のモデル. 出力は ThisGame の有効なキーコードの分だけ
+
+    :param params: PTN1_PARAMS のうち変えたい物
+    """
+    p = dict(PTN1_PARAMS, **params)
+    action_codes = ThisGame.ACTION_SPACE.actions
+    HISTORY_SIZE = p["history_size"]
+    PATTERN_SIZE1 = p["pattern_size1"]
+    EMBED_OUT_SIZE = p["embed_out_size"]
+    KSIZE1 = (3, 3*EMBED_OUT_SIZE)
+    STRIDE1 = (1, 1*EMBED_OUT_SIZE)
+    nw1 = calc_output_size(ThisGame.WIDTH*EMBED_OUT_SIZE, KSIZE1[1], STRIDE1[1])  # 13
+    nh1 = calc_output_size(ThisGame.HEIGHT, KSIZE1[0], STRIDE1[0])                # 8
+
+    PATTERN_SIZE2 = p["pattern_size2"]
+    KSIZE2  = (3, 3)
+    STRIDE2 = (1, 1)
+    nw2 = calc_output_size(nw1, KSIZE2[1], STRIDE2[1])  # 11
+    nh2 = calc_output_size(nh1, KSIZE2[0], STRIDE2[0])  # 6
+    chainer_model = FunctionSet(
+        l1=F.Convolution2D(HISTORY_SIZE, PATTERN_SIZE1, ksize=KSIZE1, stride=STRIDE1),
+        l2=F.Convolution2D(PATTERN_SIZE1, PATTERN_SIZE2, ksize=KSIZE2, stride=STRIDE2),
+        l3=F.Linear(nw2 * nh2 * PATTERN_SIZE2, p["hidden_size"]),
+        l4=F.Linear(p["hidden_size"], len(action_codes)),
+    )
+    model = EmbedAgentModel(model=chainer_model, model_name=model_name,
+                            embed_out_size=EMBED_OUT_SIZE,
+                            width=ThisGame.WIDTH, height=ThisGame.HEIGHT,
+                            history_size=HISTORY_SIZE, out_size=len(action_codes), action_codes=action_codes)
+
+    r1, r2, r3, r4 = p["drop_ratios"]
+    model.activate_functions["l1"] = relu_with_drop_ratio(r1)
+    model.activate_functions["l2"] = relu_with_drop_ratio(r2)
+    model.activate_functions["l3"] = relu_with_drop_ratio(r3)
+    model.activate_functions["l4"] = drop_ratio(r4)
+    model.compile()
+    return model
@@ -0,0 +1,164 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import numpy as np
+import chainer.functions as F
+
+
+def numpy_relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def numpy_identity(x):
+    return x
+
+
+PRECISIONS = ("float32", "float16", "int8")
+CHUNK_ROWS = 128  # float32 以外の重みは、この行数ずつ float32 に戻しながら掛ける
+
+
+def export_weight(w, precision):
+    """
+    w: [in, out] の float32 の重み -> (precision の重み, 出力 channel 毎の scale か None)
+    int8 は出力 channel 毎に max|w| が 127 になる scale で量子化する.
+    """
+    if precision == "float32":
+        return w, None
+    if precision == "float16":
+        return np.ascontiguousarray(w, dtype=np.float16), None
+    scale = np.abs(w).max(axis=0) / 127.0
+    scale[scale == 0] = 1.0
+    return np.ascontiguousarray(np.round(w / scale), dtype=np.int8), scale.astype(np.float32)
+
+
+def matmul(x, w, scale):
+    """x: [N, in], w: export_weight() の [in, out]"""
+    if w.dtype == np.float32:
+        y = np.dot(x, w)
+    else:
+        y = np.zeros((x.shape[0], w.shape[1]), dtype=np.float32)
+        buf = np.empty((CHUNK_ROWS, w.shape[1]), dtype=np.float32)  # cache に乗る大きさで使い回す
+        for i in range(0, w.shape[0], CHUNK_ROWS):
+            part = buf[:len(w[i:i+CHUNK_ROWS])]
+            part[...] = w[i:i+CHUNK_ROWS]
+            y += np.dot(x[:, i:i+CHUNK_ROWS], part)
+    if scale is not None:
+        y *= scale
+    return y
+
+
+def im2col_nhwc(x, kh, kw, sy, sx, ph, pw):
+    """
+    x: [N, H, W, C] -> [N*out_h*out_w, C*kh*kw] (列の並びは Convolution2D の W[out, C, kh, kw] と同じ)
+    """
+    if ph or pw:
+        x = np.pad(x, ((0, 0), (ph, ph), (pw, pw), (0, 0)), mode="constant")
+    n, h, w, c = x.shape
+    out_h = (h - kh) / sy + 1
+    out_w = (w - kw) / sx + 1
+    s0, s1, s2, s3 = x.strides
+    col = np.lib.stride_tricks.as_strided(x, shape=(n, out_h, out_w, c, kh, kw),
+                                          strides=(s0, s1 * sy, s2 * sx, s3, s1, s2))
+    return col.reshape(n * out_h * out_w, c * kh * kw), out_h, out_w
+
+
+class NumpyInference(object):
+    """
+    AgentModel の train=False の forward を、Variable を作らずに NumPy だけで計算する.
+    Convolution2D は im2col + 行列積、Linear は行列積. 活性化関数は numpy_function 属性の NumPy 版を使う
+    (dropout は推論では何もしないので numpy_identity).
+
+    重みは FunctionSet の配列をそのまま(view で)参照するので、optimizer の in-place の更新はそのまま反映される.
+    load などで配列そのものが入れ替わった時は refresh() を呼ぶ.
+
+    precision に "float16" か "int8"(出力 channel 毎の scale)を指定すると、重みをその精度でコピーして持つ.
+    重みのメモリは 1/2, 1/4 になるが、コピーなので重みが変わる度に refresh() が要る(compare_precision.py で精度を比べるのに使う).
+    Conv 層の間はデータを [N, H, W, C] のまま流し、Linear に渡す時だけ Chainer と同じ [N, C*H*W] の並びに戻す.
+    """
+
+    def __init__(self, agent_model, precision="float32"):
+        """
+
+        :type agent_model: AgentModel
+        :param precision: PRECISIONS のどれか
+        """
+        if precision not in PRECISIONS:
+            raise ValueError("precision must be one of %s: %s" % (PRECISIONS, precision))
+        self.agent_model = agent_model
+        self.precision = precision
+        self.compiled = {}
+
+    @staticmethod
+    def supports(agent_model):
+        """全部の層と活性化関数を NumPy で計算できるか"""
+        pipeline = agent_model.pipeline or agent_model.compile()
+        for name, activation in zip(pipeline.names, pipeline.activations):
+            layer = getattr(agent_model.function_set, name)
+            if not isinstance(layer, (F.Convolution2D, F.Linear)):
+                return False
+            if activation is not None and getattr(activation, "numpy_function", None) is None:
+                return False
+        return True
+
+    def refresh(self):
+        self.compiled = {}
+
+    def steps_for(self, function_set):
+        entry = self.compiled.get(id(function_set))
+        if entry is None or entry[0] is not function_set:
+            entry = (function_set, self.export(function_set))
+            self.compiled[id(function_set)] = entry
+        return entry[1]
+
+    def export(self, function_set):
+        """:return: (層の計算, conv の設定, 重み, scale, bias, 活性化関数) のリスト"""
+        pipeline = self.agent_model.pipeline or self.agent_model.compile()
+        steps = []
+        for name, activation in zip(pipeline.names, pipeline.activations):
+            layer = getattr(function_set, name)
+            numpy_function = activation.numpy_function if activation is not None else numpy_identity
+            if isinstance(layer, F.Convolution2D):
+                w, scale = export_weight(layer.W.reshape(layer.W.shape[0], -1).T, self.precision)
+                conv = (layer.kh, layer.kw, layer.sy, layer.sx, layer.ph, layer.pw)
+                steps.append((self.conv, conv, w, scale, layer.b, numpy_function))
+            else:
+                w, scale = export_weight(layer.W.T, self.precision)
+                steps.append((self.linear, None, w, scale, layer.b, numpy_function))
+        return steps
+
+    def weight_bytes(self, function_set=None):
+        """推論に使う重みと scale, bias のバイト数"""
+        total = 0
+        for _, _, w, scale, b, _ in self.steps_for(function_set or self.agent_model.function_set):
+            total += sum(a.nbytes for a in (w, scale, b) if a is not None)
+        return total
+
+    @staticmethod
+    def conv(x, conv, w, scale, b):
+        col, out_h, out_w = im2col_nhwc(x, *conv)
+        y = matmul(col, w, scale)
+        if b is not None:
+            y += b
+        return y.reshape(x.shape[0], out_h, out_w, w.shape[1])
+
+    @staticmethod
+    def linear(x, conv, w, scale, b):
+        if x.ndim == 4:  # [N, H, W, C] -> Chainer の [N, C, H, W] の並びで平らにする
+            x = x.transpose(0, 3, 1, 2)
+        y = matmul(x.reshape(x.shape[0], -1), w, scale)
+        if b is not None:
+            y += b
+        return y
+
+    def __call__(self, x, function_set=None):
+        """
+        :param x: [N, C, H, W] の入力
+        :param function_set: 同じ形の別の重み(target network など)で計算する時に指定する
+        :return: [N, out_size] の出力
+        """
+        steps = self.steps_for(function_set or self.agent_model.function_set)
+        if x.ndim == 4:
+            x = x.transpose(0, 2, 3, 1)
+        for func, conv, w, scale, b, activation in steps:
+            x = activation(func(x, conv, w, scale, b))
+        return x
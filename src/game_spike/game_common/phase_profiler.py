@@ -0,0 +1,57 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import os
+import time
+
+
+class PhaseProfiler(object):
+    """
+    Game.play()/step() の中のフェーズ毎に経過時間と呼び出し回数を貯める.
+    Game.profiler に入れた時だけ計測する(None の時は計測のコードを通らない).
+
+    フェーズ名:
+      * player.action
+      * game.step (get_next_state_and_reward)
+      * <Observerのクラス名>.on_update など
+      * player.on_game_over (headless の時)
+    """
+
+    def __init__(self, dump=False):
+        self.dump = dump
+        self.elapsed = {}
+        self.count = {}
+        self.last_episode = []
+
+    def add(self, phase, start_time):
+        """start_time からの経過時間を phase に足す"""
+        self.elapsed[phase] = self.elapsed.get(phase, 0.0) + (time.time() - start_time)
+        self.count[phase] = self.count.get(phase, 0) + 1
+
+    def summary(self):
+        """
+        :return: 合計時間の長い順に [(phase, 合計msec, 回数), ...]
+        """
+        return sorted([(phase, 1000.0 * sec, self.count[phase]) for phase, sec in self.elapsed.items()],
+                      key=lambda x: -x[1])
+
+    def end_episode(self, game):
+        """1ゲーム分を last_episode に移して次のゲーム用にクリアする"""
+        self.last_episode = self.summary()
+        self.elapsed = {}
+        self.count = {}
+        if self.dump:
+            print "profile play_id=%s turn=%s %s" % (
+                game.play_id, game.turn,
+                " ".join(["%s=%.1fms/%d" % x for x in self.last_episode]))
+
+    def info_list(self, limit=5):
+        """ReplayServer.info に足す用. 直前のゲームの上位 limit 個"""
+        return ["%-24s%7.1fms" % (phase[:24], msec) for phase, msec, _ in self.last_episode[:limit]]
+
+
+def create_profiler():
+    """環境変数 PROFILE が設定されていれば PhaseProfiler を返す"""
+    if os.environ.get("PROFILE", None):
+        return PhaseProfiler(dump=True)
+    return None
@@ -10,6 +10,7 @@ import socket
 import time
 
 from curse_util import ignore_error_add_str
+from base_system import ActionSpace
 
 
 def receive_all(sock):
@@ -63,6 +64,7 @@ class ReplayClient(object):
         meta_info = replay_data["meta"]
         if self.main_window is None:
             self.init_window(width, height)
+        action_space = ActionSpace(meta_info["keymap"])
 
         for scene in replay_data["scenes"]:
             t1 = time.time()
@@ -70,19 +72,18 @@ class ReplayClient(object):
             game_info["screen_width"] = width
             game_info["screen_height"] = height
             screen = scene["screen"]
-            self.update_screen(game_info, screen, meta_info, replay_data.get("info", []))
+            self.update_screen(game_info, screen, meta_info, action_space, replay_data.get("info", []))
             t2 = time.time() - t1
             if t2 < self.SEC_PER_TURN:
                 time.sleep(self.SEC_PER_TURN - t2)
 
-    def update_screen(self, game, screen, meta, extra_info_list):
+    def update_screen(self, game, screen, meta, action_space, extra_info_list):
         for y in range(game["screen_height"]):
             line = "".join([chr(ch) for ch in screen[y]])
             ignore_error_add_str(self.main_window, y, 0, line)
         self.main_window.refresh()
 
-        last_action = game["last_action"]
-        keymap = meta["keymap"]
+        key_flags = action_space.key_tuples[game["last_action"] or 0]
         play_id = meta["play_id"]
 
         self.info_window.clear()
@@ -92,14 +93,9 @@ class ReplayClient(object):
             "Total Score: %s" % game["total_reward"],
             "This Reward: %s" % game["last_reward"],
             "=== Action ===",
-            "Left : %d" % (keymap["LEFT"] & last_action > 0),
-            "Right: %d" % (keymap["RIGHT"] & last_action > 0),
-            "Up   : %d" % (keymap["UP"] & last_action > 0),
-            "Down : %d" % (keymap["DOWN"] & last_action > 0),
-            "A    : %d" % (keymap["A"] & last_action > 0),
-            "B    : %d" % (keymap["B"] & last_action > 0),
-            "=== Info ===",
             ]
+        info_list += ["%-5s: %d" % (label, pressed) for label, pressed in zip(ActionSpace.KEY_LABELS, key_flags)]
+        info_list += ["=== Info ==="]
         info_list += extra_info_list
         self.write_info_lines(info_list)
         self.info_window.refresh()
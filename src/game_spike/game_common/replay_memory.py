@@ -0,0 +1,161 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import numpy as np
+
+
+class ReplayMemory(object):
+    """
+    遷移を貯めておくリングバッファ. 配列は最初に全部確保する.
+
+    1遷移は Agent の state_history_array 1つ分:
+      histories[i][1:]  : 行動を選んだ時の state
+      histories[i][:-1] : その結果の state
+      actions[i], rewards[i], terminals[i](結果の state でゲームオーバーか)
+      episode_ids[i]: どのゲームの遷移か. 同じ episode_id が続いている所は連続した遷移として n-step で使う
+    """
+
+    def __init__(self, capacity, history_size, height, width):
+        self.capacity = capacity
+        self.histories = np.zeros([capacity, history_size+1, height, width], dtype=np.float32)
+        self.actions = np.zeros([capacity], dtype=np.int32)
+        self.rewards = np.zeros([capacity], dtype=np.float32)
+        self.terminals = np.zeros([capacity], dtype=np.bool_)
+        self.episode_ids = np.zeros([capacity], dtype=np.int64)
+        self.history_size = history_size
+        self.pointer = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, history_array, action, reward, terminal, episode_id=0):
+        i = self.pointer
+        self.histories[i] = history_array
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.terminals[i] = terminal
+        self.episode_ids[i] = episode_id
+        self.pointer = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def sample_indices(self, batch_size):
+        """:return: (indices, importance-sampling weights)"""
+        return np.random.randint(0, self.count, size=batch_size), np.ones([batch_size], dtype=np.float32)
+
+    def sample(self, batch_size, n_step=1, gamma=0.99):
+        """
+        target = returns + discounts * max Q(next_states) で学習する為の batch_size 個分のコピー.
+
+        :return: (indices, last_states, actions, returns, discounts, next_states, weights)
+        """
+        idx, weights = self.sample_indices(batch_size)
+        returns, discounts, last_idx = self.n_step_returns(idx, n_step, gamma)
+        last_states = self.histories[idx, 1:]
+        next_states = self.histories[last_idx, :self.history_size]
+        return idx, last_states, self.actions[idx], returns, discounts, next_states, weights
+
+    def n_step_returns(self, idx, n_step, gamma):
+        """
+        idx から n_step 個先までの割引報酬和を batch 分まとめて計算する.
+        ゲームオーバー(terminals)、別のゲームの遷移、まだ書かれていない所で打ち切る.
+
+        :return: (returns [N], 残りに掛ける割引 [N] (ゲームオーバーで終わったら0), 最後に使った遷移の index [N])
+        """
+        n = len(idx)
+        offsets = np.arange(n_step)
+        j = (idx.reshape(n, 1) + offsets) % self.capacity                    # [N, n_step]
+        newer_count = (self.pointer - idx - 1) % self.capacity + 1            # idx から最新までの数
+        continued = (offsets < newer_count.reshape(n, 1)) & \
+                    (self.episode_ids[j] == self.episode_ids[idx].reshape(n, 1))
+        continued[:, 1:] &= ~self.terminals[j[:, :-1]]
+        valid = np.cumprod(continued, axis=1).astype(np.bool_)
+        valid[:, 0] = True
+
+        returns = np.sum(np.where(valid, self.rewards[j] * gamma ** offsets, 0), axis=1).astype(np.float32)
+        steps = np.sum(valid, axis=1)
+        last_idx = j[np.arange(n), steps - 1]
+        discounts = (gamma ** steps * ~self.terminals[last_idx]).astype(np.float32)
+        return returns, discounts, last_idx
+
+    def update_priorities(self, indices, td_errors):
+        pass
+
+
+class SumTree(object):
+    """
+    葉に priority を持つ完全二分木(配列表現). tree[1] が合計, tree[i] の子は tree[2i], tree[2i+1].
+    更新も検索も O(log n) で、どちらも batch 分をまとめて NumPy で行う.
+    """
+
+    def __init__(self, capacity):
+        self.leaf_offset = 1
+        while self.leaf_offset < capacity:
+            self.leaf_offset *= 2
+        self.tree = np.zeros([2 * self.leaf_offset], dtype=np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, priorities):
+        node = np.asarray(indices) + self.leaf_offset
+        self.tree[node] = priorities
+        node = np.unique(node // 2)
+        while node[0] > 0:
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+            node = np.unique(node // 2)
+
+    def find(self, values):
+        """
+        累積和が values になる葉を探す.
+
+        :return: 葉の index の配列
+        """
+        values = np.array(values, dtype=np.float64)
+        node = np.ones([len(values)], dtype=np.int64)
+        while node[0] < self.leaf_offset:
+            left = 2 * node
+            go_right = values >= self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0)
+            node = left + go_right
+        return node - self.leaf_offset
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    TD誤差の大きい遷移ほどよく取り出す ReplayMemory (Prioritized Experience Replay).
+    新しい遷移はその時点の最大 priority で入れる.
+    取り出した分の偏りは importance-sampling weight で打ち消す(BETA は 1 に向けて増やす).
+    """
+    ALPHA = 0.6
+    BETA = 0.4
+    BETA_INCREMENT = 0.00001
+    EPSILON = 0.0001
+
+    def __init__(self, capacity, history_size, height, width):
+        super(PrioritizedReplayMemory, self).__init__(capacity, history_size, height, width)
+        self.sum_tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.beta = self.BETA
+
+    def add(self, history_array, action, reward, terminal, episode_id=0):
+        i = self.pointer
+        super(PrioritizedReplayMemory, self).add(history_array, action, reward, terminal, episode_id)
+        self.sum_tree.update([i], self.max_priority)
+
+    def sample_indices(self, batch_size):
+        # 合計を batch_size 個の区間に分けて、それぞれの区間から1つずつ取る
+        segment = self.sum_tree.total / batch_size
+        values = (np.arange(batch_size) + np.random.random(batch_size)) * segment
+        idx = np.minimum(self.sum_tree.find(values), self.count - 1)
+
+        probs = self.sum_tree.tree[idx + self.sum_tree.leaf_offset] / self.sum_tree.total
+        weights = (self.count * np.maximum(probs, 1e-12)) ** -self.beta
+        self.beta = min(1.0, self.beta + self.BETA_INCREMENT)
+        return idx, (weights / np.max(weights)).astype(np.float32)
+
+    def update_priorities(self, indices, td_errors):
+        priorities = (np.abs(td_errors) + self.EPSILON) ** self.ALPHA
+        self.sum_tree.update(indices, priorities)
+        self.max_priority = max(self.max_priority, np.max(priorities))
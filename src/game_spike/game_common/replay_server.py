@@ -35,8 +35,10 @@ class ReplayServer(object):
                 sock.close()
 
     def handle(self, conn):
-        data = dumps(self.last_play,  HIGHEST_PROTOCOL)
-        conn.send(data)
+        conn.send(self.serialize())
+
+    def serialize(self):
+        return dumps(self.last_play, HIGHEST_PROTOCOL)
 
     def on_game_start(self, game):
         self.current_play = {
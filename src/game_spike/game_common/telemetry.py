@@ -0,0 +1,129 @@
+# coding: utf-8
+__author__ = 'k_morishita'
+
+import json
+import math
+import os
+import time
+
+
+class RollingStats(object):
+    """
+    直近 window 個の値の平均と分散を、値を1つ足す度に O(1) で更新する(スライディング窓の Welford 法).
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.values = [0.0] * window
+        self.pointer = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last = None
+
+    def reset(self):
+        self.pointer = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.last = None
+
+    def add(self, x):
+        x = float(x)
+        if self.count < self.window:
+            self.count += 1
+            delta = x - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (x - self.mean)
+        else:
+            old = self.values[self.pointer]
+            old_mean = self.mean
+            self.mean += (x - old) / self.window
+            self.m2 += (x - old) * (x - self.mean + old - old_mean)
+        self.values[self.pointer] = x
+        self.pointer = (self.pointer + 1) % self.window
+        self.last = x
+
+    @property
+    def var(self):
+        return max(self.m2, 0.0) / self.count if self.count else 0.0
+
+    @property
+    def std(self):
+        return math.sqrt(self.var)
+
+    def to_dict(self):
+        return {"mean": self.mean, "std": self.std, "last": self.last, "n": self.count}
+
+
+class Telemetry(object):
+    """
+    学習の様子(loss, TD誤差, Q値, 1ゲームの得点, steps/sec, updates/sec)を集めて、
+    interval 秒に1回まで JSON 1行にして GameRepository の telemetry ディレクトリに追記する.
+    """
+    WINDOW = 100
+    INTERVAL = 10  # 秒. 0 ならファイルに書かない
+
+    def __init__(self, repo, model_name, interval=None, window=None):
+        """
+
+        :type repo: GameRepository
+        """
+        if interval is None:
+            interval = float(os.environ.get("TELEMETRY_INTERVAL", self.INTERVAL))
+        self.interval = interval
+        self.window = window or self.WINDOW
+        self.path = repo.get_telemetry_path(model_name) if interval > 0 else None
+        self.model_name = model_name
+        self.stats = {}
+        self.steps = 0
+        self.updates = 0
+        self.episodes = 0
+        self.last_write = (time.time(), 0, 0)  # (time, steps, updates)
+
+    def add(self, name, value):
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = RollingStats(self.window)
+        stats.add(value)
+
+    def on_step(self):
+        self.steps += 1
+
+    def on_update(self):
+        self.updates += 1
+
+    def on_episode(self, total_reward):
+        self.episodes += 1
+        self.add("episode_reward", total_reward)
+
+    def maybe_write(self):
+        """前回書いてから interval 秒以上経っていたら1行書く"""
+        if time.time() - self.last_write[0] >= self.interval:
+            self.write()
+
+    def flush(self):
+        """終了する時に呼ぶ. 前回書いた後に進んだ分があれば interval を待たずに書く"""
+        if (self.steps, self.updates) != self.last_write[1:]:
+            self.write()
+
+    def write(self):
+        now = time.time()
+        last_time, last_steps, last_updates = self.last_write
+        if self.path is None:
+            return
+        elapsed = max(now - last_time, 1e-6)
+        record = {
+            "time": now,
+            "model": self.model_name,
+            "steps": self.steps,
+            "updates": self.updates,
+            "episodes": self.episodes,
+            "steps_per_sec": (self.steps - last_steps) / elapsed,
+            "updates_per_sec": (self.updates - last_updates) / elapsed,
+        }
+        for name, stats in self.stats.items():
+            record[name] = stats.to_dict()
+        with file(self.path, "a") as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+        self.last_write = (now, self.steps, self.updates)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+__author__ = 'k_morishita'
+
+import numpy as np
+
+
+class VecAsciiGame(object):
+    """
+    N個の AsciiGame をまとめて NumPy 配列で持ち、1回の step(actions) で全部進める.
+
+    * screens: [N, HEIGHT, WIDTH] int8
+    * 終了したゲームは step() の中で自動的にリセットされる
+    (終了時の turn と total_reward は info に入る)
+
+    サブクラスは game_class と prepare_games(), get_next_states_and_rewards() を定義する.
+    """
+    game_class = None  # AsciiGame のサブクラス
+
+    def __init__(self, num_games):
+        self.num_games = num_games
+        self.WIDTH = self.game_class.WIDTH
+        self.HEIGHT = self.game_class.HEIGHT
+        self.index = np.arange(num_games)
+        self.screens = np.zeros([num_games, self.HEIGHT, self.WIDTH], dtype=np.int8)
+        self.turns = np.zeros([num_games], dtype=np.int32)
+        self.total_rewards = np.zeros([num_games], dtype=np.float32)
+        self.play_ids = np.zeros([num_games], dtype=np.int32)
+        self.action_space = self.game_class.ACTION_SPACE
+        self.reset()
+
+    def reset(self):
+        self.reset_games(self.index)
+        return self.screens
+
+    def reset_games(self, indices):
+        self.turns[indices] = 0
+        self.total_rewards[indices] = 0
+        self.play_ids[indices] += 1
+        self.prepare_games(indices)
+
+    def step(self, actions):
+        """
+        :param actions: [N] のキーコード
+        :return: (screens, rewards, dones, info)
+                 screens は内部配列そのものなので、取っておく場合は copy すること
+        """
+        actions = np.asarray(actions, dtype=np.int32)
+        actions = np.where((0 <= actions) & (actions < 64), actions, 0)
+        self.turns += 1
+        rewards, dones = self.get_next_states_and_rewards(actions)
+        self.total_rewards += rewards
+        done_indices = np.flatnonzero(dones)
+        info = {
+            "done_indices": done_indices,
+            "turns": self.turns[done_indices],
+            "total_rewards": self.total_rewards[done_indices],
+        }
+        if len(done_indices) > 0:
+            self.reset_games(done_indices)
+        return self.screens, rewards, dones, info
+
+    def key_pressed(self, actions, key_name):
+        """:return: [N] bool"""
+        return self.action_space.key_flags[actions, self.action_space.key_index(key_name)]
+
+    def prepare_games(self, indices):
+        raise NotImplemented()
+
+    def get_next_states_and_rewards(self, actions):
+        """
+        :return: (rewards [N] float32, dones [N] bool)
+        """
+        raise NotImplemented()
@@ -4,17 +4,14 @@
 __author__ = 'k_morishita'
 
 import os
-import random
-import itertools
 
-from chainer import FunctionSet
-import chainer.functions as F
+import numpy as np
 
-from game_common.base_system import AsciiGame, Screen, StateBase
+from game_common.base_system import AsciiGame, ActionSpace, Screen, StateBase
+from game_common.vec_game import VecAsciiGame
 from game_common.debug_game import debug_game
 from game_common.ascii_game_player_agent import agent_play, AsciiGamePlayerAgent
-from game_common.agent_model import AgentModel
-from game_common.agent_model import EmbedAgentModel
+from game_common.model_builder import build_ptn1_model
 
 
 class State(StateBase):
@@ -23,13 +20,45 @@ class State(StateBase):
     power = 3
     jumping_down = False
 
+class JumpCourse(object):
+    """
+    地面(BLOCK/SPACE)の列を Game 毎の乱数でまとめて作っておき、位置で表引きする.
+    cells[0:WIDTH] が最初の画面の地面、cells[WIDTH-1+turn] が turn で右端に出てくる地面.
+    """
+    CHUNK_SIZE = 1024
+
+    def __init__(self, seed, width, space_rate, initial_space_rate, block, space):
+        self.seed = seed
+        self.random = np.random.RandomState(seed)
+        self.space_rate = space_rate
+        self.block = block
+        self.space = space
+        self.cells = self.gen_cells(width, initial_space_rate)
+
+    def gen_cells(self, size, space_rate):
+        return np.where(self.random.random_sample(size) < space_rate, self.space, self.block).astype(np.int8)
+
+    def extend_to(self, size):
+        while len(self.cells) < size:
+            self.cells = np.concatenate([self.cells, self.gen_cells(self.CHUNK_SIZE, self.space_rate)])
+
+    def __getitem__(self, index):
+        """index は int でも array でも良い"""
+        self.extend_to(np.max(index) + 1)
+        return self.cells[index]
+
+
 class JumpGame(AsciiGame):
     PLAYER = ord("P")
     BLOCK = ord("=")
     SPACE = ord(" ")
     space_rate = 0.2
+    initial_space_rate = 0.05
     PY_MAX = 8
     POWER_MAX = 3
+    course_seed = 0
+    course = None
+    ACTION_SPACE = ActionSpace(AsciiGame.KEYMAP, [(0, AsciiGame.BUTTON_A), (0, AsciiGame.KEY_LEFT, AsciiGame.KEY_RIGHT)])
 
     # must be defined
     def prepare_game(self):
@@ -44,14 +73,14 @@ class JumpGame(AsciiGame):
         # Scroll
         screen = state.screen
         screen.scroll_x(-1)
-        screen[self.PY_MAX+1, self.WIDTH-1] = self.gen_block_or_space()
+        screen[self.PY_MAX+1, self.WIDTH-1] = self.course[self.WIDTH-1 + self.turn]
         self.draw_player()
 
         ######## decide reward
         reward = 0.05
 
         # key penalty
-        if action not in self.effective_actions():  # 余分なKeyを押したらペナルティとする(親切)
+        if not self.ACTION_SPACE.contains(action):  # 余分なKeyを押したらペナルティとする(親切)
             reward -= 0.1
 
         # if state.py < self.PY_MAX and screen[self.PY_MAX+1, state.px] == self.SPACE:  # 穴の上では報酬がある
@@ -64,25 +93,29 @@ class JumpGame(AsciiGame):
 
         return state, reward
 
-    # should be defined
-    def effective_actions(self):
-        ret = set()
-        key_combinations = [(0, self.BUTTON_A), (0, self.KEY_LEFT, self.KEY_RIGHT)]
-        for key_code_list in itertools.product(*key_combinations):
-            ret.add(reduce(lambda t, x: t | x, key_code_list))
-        return list(ret)
+    # should be defined for snapshot()
+    def pack_entities(self, state):
+        return [self.course_seed, state.px, state.py, state.power, state.jumping_down]
+
+    def unpack_entities(self, state, values):
+        self.course_seed, state.px, state.py, state.power = [int(v) for v in values[:4]]
+        state.jumping_down = bool(values[4])
+        self.prepare_course()
 
     # private methods
     def init_course(self):
+        self.prepare_course()
         self.state.screen.fill(self.SPACE)
-        self.state.screen[self.PY_MAX+1] = [self.gen_block_or_space(0.05) for _ in range(self.WIDTH)]
+        self.state.screen[self.PY_MAX+1] = self.course.cells[:self.WIDTH]
+
+    def set_seed(self, seed):
+        self.course_seed = seed
 
-    def gen_block_or_space(self, space_rate=None):
-        space_rate = space_rate or self.space_rate
-        random.seed(self.turn+1)
-        ret = self.SPACE if random.random() < space_rate else self.BLOCK
-        random.seed(0)
-        return ret
+    def prepare_course(self):
+        """course_seed が同じなら毎回同じコース"""
+        if self.course is None or self.course.seed != self.course_seed:
+            self.course = JumpCourse(self.course_seed, self.WIDTH, self.space_rate, self.initial_space_rate,
+                                     self.BLOCK, self.SPACE)
 
     def draw_player(self, erase=False):
         self.state.screen[self.state.py, self.state.px] = self.SPACE if erase else self.PLAYER
@@ -90,13 +123,13 @@ class JumpGame(AsciiGame):
     def move_player(self, state, action):
         # MOVE Player
         self.draw_player(erase=True)
+        left, right, _, _, jump_key_pressed, _ = self.pressed_keys(action)
 
-        if action & self.KEY_LEFT and state.px > 0:
+        if left and state.px > 0:
             state.px -= 1
-        if action & self.KEY_RIGHT and state.px < self.WIDTH-1:
+        if right and state.px < self.WIDTH-1:
             state.px += 1
 
-        jump_key_pressed = action & self.BUTTON_A
         if jump_key_pressed and state.power > 0 and not state.jumping_down:
             state.power -= 1
             if state.power == 0:
@@ -112,58 +145,74 @@ class JumpGame(AsciiGame):
                 state.jumping_down = False
 
 
+class VecJumpGame(VecAsciiGame):
+    game_class = JumpGame
+
+    def __init__(self, num_games, course_seed=0):
+        g = self.game_class
+        self.px = np.zeros([num_games], dtype=np.int32)
+        self.py = np.zeros([num_games], dtype=np.int32)
+        self.power = np.zeros([num_games], dtype=np.int32)
+        self.jumping_down = np.zeros([num_games], dtype=np.bool_)
+        self.course = JumpCourse(course_seed, g.WIDTH, g.space_rate, g.initial_space_rate, g.BLOCK, g.SPACE)
+        super(VecJumpGame, self).__init__(num_games)
+
+    def prepare_games(self, indices):
+        g = self.game_class
+        self.screens[indices] = g.SPACE
+        self.screens[indices, g.PY_MAX+1, :] = self.course.cells[:self.WIDTH]
+        self.px[indices] = State.px
+        self.py[indices] = State.py
+        self.power[indices] = State.power
+        self.jumping_down[indices] = State.jumping_down
+        self.screens[indices, self.py[indices], self.px[indices]] = g.PLAYER
+
+    def get_next_states_and_rewards(self, actions):
+        g = self.game_class
+        self.move_players(actions)
+        # Scroll
+        self.screens = np.roll(self.screens, -1, axis=2)
+        self.screens[:, g.PY_MAX+1, self.WIDTH-1] = self.course[self.WIDTH-1 + self.turns]
+        self.screens[self.index, self.py, self.px] = g.PLAYER
+
+        # decide reward
+        rewards = np.where(self.action_space.mask[actions], 0.05, -0.05).astype(np.float32)
+        dones = (self.py == g.PY_MAX) & (self.screens[self.index, g.PY_MAX+1, self.px] == g.SPACE)
+        rewards[dones] = -1
+        return rewards, dones
+
+    def move_players(self, actions):
+        g = self.game_class
+        self.screens[self.index, self.py, self.px] = g.SPACE
+
+        self.px -= self.key_pressed(actions, "LEFT") & (self.px > 0)
+        self.px += self.key_pressed(actions, "RIGHT") & (self.px < self.WIDTH-1)
+
+        jump = self.key_pressed(actions, "A") & (self.power > 0) & ~self.jumping_down
+        self.power -= jump
+        self.jumping_down |= jump & (self.power == 0)
+        self.py -= jump
+
+        fall = ~jump & (self.py < g.PY_MAX)
+        self.py += fall
+        self.jumping_down |= fall
+
+        landing = ~jump & ~fall
+        self.power[landing] = g.POWER_MAX
+        self.jumping_down[landing] = False
+
+
 def ptn1(ThisGame, model_name):
-    HISTORY_SIZE = 3
-    PATTERN_SIZE1 = 50
-    EMBED_OUT_SIZE = 3
-    KSIZE1 = (3, 3*EMBED_OUT_SIZE)
-    STRIDE1 = (1, 1*EMBED_OUT_SIZE)
-    nw1 = calc_output_size(ThisGame.WIDTH*EMBED_OUT_SIZE, KSIZE1[1], STRIDE1[1])  # 13
-    nh1 = calc_output_size(ThisGame.HEIGHT, KSIZE1[0], STRIDE1[0])                # 8
-
-    PATTERN_SIZE2 = 100
-    KSIZE2  = (3, 3)
-    STRIDE2 = (1, 1)
-    nw2 = calc_output_size(nw1, KSIZE2[1], STRIDE2[1])  # 11
-    nh2 = calc_output_size(nh1, KSIZE2[0], STRIDE2[0])  # 6
-    chainer_model = FunctionSet(
-        l1=F.Convolution2D(HISTORY_SIZE, PATTERN_SIZE1, ksize=KSIZE1, stride=STRIDE1),
-        l2=F.Convolution2D(PATTERN_SIZE1, PATTERN_SIZE2, ksize=KSIZE2, stride=STRIDE2),
-        l3=F.Linear(nw2 * nh2 * PATTERN_SIZE2, 1000),
-        l4=F.Linear(1000, 64),
-    )
-    model = EmbedAgentModel(model=chainer_model, model_name=model_name,
-                            embed_out_size=EMBED_OUT_SIZE,
-                            width=ThisGame.WIDTH, height=ThisGame.HEIGHT,
-                            history_size=HISTORY_SIZE, out_size=64)
-
-    def relu_with_drop_ratio(ratio):
-        def f(x, train=True):
-            return F.dropout(F.relu(x), train=train, ratio=ratio)
-        return f
-
-    def drop_ratio(ratio):
-        def f(x, train=True):
-            return F.dropout(x, train=train, ratio=ratio)
-        return f
-
-    model.activate_functions["l1"] = relu_with_drop_ratio(0.2)
-    model.activate_functions["l2"] = relu_with_drop_ratio(0.4)
-    model.activate_functions["l3"] = relu_with_drop_ratio(0.5)
-    model.activate_functions["l4"] = drop_ratio(0.7)
+    model = build_ptn1_model(ThisGame, model_name)
     player = AsciiGamePlayerAgent(model)
     player.ALPHA = 0.01
     agent_play(ThisGame, player)
 
 
 if __name__ == '__main__':
-    def calc_output_size(screen_size, ksize, stride):
-        return (screen_size - ksize) / stride + 1
-
     if os.environ.get("DEBUG_PLAY", None):
         print "Debug Mode"
         debug_game(JumpGame)
     else:
         print "EmbedID Mode"
         ptn1(JumpGame, 'JumpGame')
-
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+__author__ = 'k_morishita'
+
+"""
+モデルの形や学習の設定を変えた組み合わせを、プロセスプールで並列に headless 学習させて比べる.
+
+    python sweep.py spec.json [--processes 4] [--output summary.tsv]
+
+spec.json の例:
+    {
+      "game": "JumpGame",
+      "name": "sweep1",            # モデル名は <name>_<job番号>
+      "search": "grid",            # grid: 全組み合わせ, random: num_samples 個をランダムに選ぶ
+      "num_samples": 10,
+      "seed": 0,
+      "budget_steps": 20000,       # 1 job の学習ターン数の上限 (0 なら無し)
+      "budget_seconds": 600,       # 1 job の学習時間の上限 (0 なら無し. どちらか1つは必要)
+      "eval_episodes": 10,         # 学習後に greedy で遊ぶ回数
+      "params": {
+        "history_size": [2, 3, 4],
+        "hidden_size": [256, 1000],
+        "lr": [0.00025, 0.001]
+      }
+    }
+
+params に使える名前は MODEL_PARAMS, OPTIMIZER_PARAMS, AGENT_PARAMS のキー.
+"""
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from evaluate import GAMES, play_greedy
+from game_common.ascii_game_player_agent import AsciiGamePlayerAgent, QuitGameException, play_headless
+from game_common.game_repository import GameRepository
+from game_common.model_builder import PTN1_PARAMS, build_ptn1_model
+
+MODEL_PARAMS = sorted(PTN1_PARAMS.keys())
+OPTIMIZER_PARAMS = sorted(AsciiGamePlayerAgent.OPTIMIZER_PARAMS.keys())
+AGENT_PARAMS = ["batch_size", "replay_memory_size", "target_update_interval", "n_step"]
+SUMMARY_COLUMNS = ["job", "model", "steps", "episodes", "seconds", "steps_per_sec",
+                   "train_score", "eval_mean", "eval_p50", "nan_resets"]
+TRAIN_SCORE_EPISODES = 20  # 学習の最後の何ゲームの平均を train_score にするか
+EVAL_SEED = 10000
+EVAL_MAX_TURNS = 10000
+
+
+def make_configs(spec):
+    """:return: params の dict のリスト"""
+    names = sorted(spec["params"].keys())
+    values = [spec["params"][name] for name in names]
+    if spec.get("search", "grid") == "grid":
+        return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+    rnd = random.Random(spec.get("seed", 0))
+    return [dict((name, rnd.choice(v)) for name, v in zip(names, values))
+            for _ in range(spec.get("num_samples", 10))]
+
+
+def pick(params, keys):
+    return dict((k, v) for k, v in params.items() if k in keys)
+
+
+def run_job(job):
+    job_id, spec, params, model_name, repo_dir = job
+    seed = spec.get("seed", 0) + job_id
+    np.random.seed(seed)
+    random.seed(seed)
+
+    game_class = GAMES[spec["game"]]
+    model = build_ptn1_model(game_class, model_name, **pick(params, MODEL_PARAMS))
+    agent = AsciiGamePlayerAgent(model, repo=GameRepository(repo_dir),
+                                 optimizer_params=pick(params, OPTIMIZER_PARAMS), **pick(params, AGENT_PARAMS))
+    game = game_class(agent)
+    game.headless = True
+    agent.set_action_space(game.ACTION_SPACE)
+
+    budget_steps = spec.get("budget_steps", 0)
+    budget_seconds = spec.get("budget_seconds", 0)
+    steps = 0
+    scores = []
+    nan_resets = 0
+    start_time = time.time()
+    while (not budget_steps or steps < budget_steps) and \
+            (not budget_seconds or time.time() - start_time < budget_seconds):
+        try:
+            play_headless(game, agent)
+            scores.append(game.total_reward)
+        except QuitGameException:
+            agent.load_model_parameters()
+            nan_resets += 1
+        steps += game.turn
+    seconds = time.time() - start_time
+    agent.checkpointer.request()
+    agent.checkpointer.flush()
+
+    agent.training = False
+    agent.use_greedy = False
+    eval_scores = [play_greedy(game, agent, EVAL_SEED + k, EVAL_MAX_TURNS)[0]
+                   for k in range(spec.get("eval_episodes", 10))]
+    result = {
+        "job": job_id,
+        "model": model_name,
+        "steps": steps,
+        "episodes": len(scores),
+        "seconds": seconds,
+        "steps_per_sec": steps / seconds,
+        "train_score": np.mean(scores[-TRAIN_SCORE_EPISODES:]) if scores else None,
+        "eval_mean": np.mean(eval_scores) if eval_scores else None,
+        "eval_p50": np.median(eval_scores) if eval_scores else None,
+        "nan_resets": nan_resets,
+    }
+    result.update(params)
+    return result
+
+
+def format_value(v):
+    if isinstance(v, float):
+        return "%.4g" % v
+    return str(v)
+
+
+def write_summary(results, param_names, out, aligned=False):
+    """TSV で書く. aligned なら画面で読みやすいように空白で列を揃える"""
+    columns = SUMMARY_COLUMNS + param_names
+    rows = [columns] + [[format_value(r.get(c)) for c in columns] for r in results]
+    if aligned:
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        for row in rows:
+            out.write("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() + "\n")
+    else:
+        for row in rows:
+            out.write("\t".join(row) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hyperparameter/architecture sweep")
+    parser.add_argument("spec", help="JSON sweep spec")
+    parser.add_argument("--processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument("--repo-dir", help="GameRepository base dir (default: ~/.game)")
+    parser.add_argument("--output", help="summary TSV (default: <repo>/sweep_<name>.tsv)")
+    parser.add_argument("--resume", action="store_true", help="continue training models that already exist")
+    args = parser.parse_args()
+
+    with file(args.spec) as f:
+        spec = json.load(f)
+    if spec.get("game") not in GAMES:
+        parser.error("game must be one of %s" % sorted(GAMES.keys()))
+    unknown = set(spec["params"]) - set(MODEL_PARAMS + OPTIMIZER_PARAMS + AGENT_PARAMS)
+    if unknown:
+        parser.error("unknown params: %s" % sorted(unknown))
+    if spec.get("budget_steps", 0) <= 0 and spec.get("budget_seconds", 0) <= 0:
+        parser.error("budget_steps or budget_seconds must be positive")
+
+    repo = GameRepository(args.repo_dir)
+    name = spec.get("name", "sweep_%s" % spec["game"])
+    configs = make_configs(spec)
+    jobs = [(i, spec, params, "%s_%03d" % (name, i), repo.base_dir) for i, params in enumerate(configs)]
+    existing = [model_name for _, _, _, model_name, _ in jobs if os.path.exists(repo.get_model_path(model_name))]
+    if existing and not args.resume:
+        parser.error("models already exist (use --resume or another name): %s" % ", ".join(existing))
+
+    print "%d jobs, %d processes" % (len(jobs), args.processes)
+    pool = multiprocessing.Pool(args.processes, maxtasksperchild=1)
+    try:
+        results = []
+        for result in pool.imap_unordered(run_job, jobs):
+            print "done: %s eval_mean=%s steps/sec=%.1f" % (result["model"], format_value(result["eval_mean"]),
+                                                          result["steps_per_sec"])
+            results.append(result)
+    finally:
+        pool.terminate()
+
+    results.sort(key=lambda r: r["job"])
+    param_names = sorted(spec["params"].keys())
+    output = args.output or "%s/sweep_%s.tsv" % (repo.base_dir, name)
+    with file(output, "w") as f:
+        write_summary(results, param_names, f)
+    write_summary(results, param_names, sys.stdout, aligned=True)
+    print "summary: %s" % output
+
+
+if __name__ == '__main__':
+    main()
@@ -4,78 +4,88 @@
 __author__ = 'k_morishita'
 
 import os
-import copy
 
-import random
-import itertools
+import numpy as np
 
-from chainer import FunctionSet
-import chainer.functions as F
-
-from game_common.base_system import AsciiGame, Screen, StateBase
+from game_common.base_system import AsciiGame, ActionSpace, Screen, StateBase
+from game_common.vec_game import VecAsciiGame
 from game_common.debug_game import debug_game
 from game_common.ascii_game_player_agent import agent_play, AsciiGamePlayerAgent
-from game_common.agent_model import EmbedAgentModel
-
-
-class Pos(object):
-    def __init__(self, x=0, y=0):
-        self.x = x
-        self.y = y
+from game_common.model_builder import build_ptn1_model
 
-    def __eq__(self, other):
-        return isinstance(other, Pos) and self.x == other.x and self.y == other.y
-
-class Treasure(object):
-    def __init__(self, pos):
-        self.pos = pos
 
 class Enemy(object):
-    def __init__(self, pos, counter_max):
-        self.pos = pos
-        self.counter_max = counter_max
-        self.counter = counter_max
-
-    def move(self, state):
-        self.counter -= 1
-        if self.counter == 0:
-            self.counter = self.counter_max
-            self.do_move(state)
-
-def sign(x):
-    if x == 0:
-        return 0
-    elif x < 0:
-        return -1
-    else:
-        return 1
+    """
+    敵の種類. 位置は配列で持つので、ここには動き方だけを書く.
+    move_step() は Player までの距離 d [..., (dx, dy)] から1回分の移動量を返す(何体分でもまとめて計算する).
+    """
+    CHAR = None
+
+    @staticmethod
+    def move_step(d):
+        raise NotImplemented()
 
 class EnemyX(Enemy):
     """遅いけどPlayer に向かって一直線"""
     CHAR = ord("X")
 
-    def do_move(self, state):
-        self.pos.x += sign(state.player_pos.x - self.pos.x)
-        self.pos.y += sign(state.player_pos.y - self.pos.y)
+    @staticmethod
+    def move_step(d):
+        return np.sign(d)
 
 class EnemyY(Enemy):
     """ちょっと速いけど、縦か横にしか動けない"""
     CHAR = ord("Y")
 
-    def do_move(self, state):
-        dx = state.player_pos.x - self.pos.x
-        dy = state.player_pos.y - self.pos.y
-        if abs(dx) <= abs(dy):
-            self.pos.y += sign(state.player_pos.y - self.pos.y)
-        else:
-            self.pos.x += sign(state.player_pos.x - self.pos.x)
+    @staticmethod
+    def move_step(d):
+        step = np.sign(d)
+        along_y = np.abs(d[..., 0]) <= np.abs(d[..., 1])
+        step[..., 0] *= ~along_y
+        step[..., 1] *= along_y
+        return step
+
+def move_enemy_positions(enemy_pos, enemy_counter, enemy_counter_max, enemy_groups, player_pos):
+    """
+    敵をまとめて動かす. 先頭に Game の次元が付いていても良い.
+
+    :param enemy_pos: [..., E, (x, y)]  (その場で書き換える)
+    :param enemy_counter: [..., E]      (その場で書き換える)
+    :param enemy_groups: [(Enemy のサブクラス, その種類の敵の index 配列), ...]
+    :param player_pos: [..., (x, y)]
+    :return: 動いた敵の mask [..., E]
+    """
+    enemy_counter -= 1
+    moving = enemy_counter == 0
+    enemy_counter[moving] = np.broadcast_to(enemy_counter_max, moving.shape)[moving]
+
+    d = player_pos[..., np.newaxis, :] - enemy_pos
+    step = np.zeros_like(d)
+    for enemy_class, index in enemy_groups:
+        step[..., index, :] = enemy_class.move_step(d[..., index, :])
+    enemy_pos += step * moving[..., np.newaxis]
+    return moving
+
+def choose_treasure_cells(screen_data, stage, num_treasures, space, seed=0):
+    """
+    stage と seed 毎に決まった乱数で、空いているマスから num_treasures 個の宝の位置を選ぶ.
+    RandomState の seed は 2**32 未満でないといけないので、大きな seed (evaluate.py --seed 5000 など) は畳み込む.
+
+    :return: 選んだマスの (ys, xs)
+    """
+    free_cells = np.flatnonzero(screen_data == space)
+    rnd = np.random.RandomState((stage * 1000 + seed * 1000003) % (2 ** 32))
+    cells = rnd.choice(free_cells, min(num_treasures, len(free_cells)), replace=False)
+    return np.unravel_index(cells, screen_data.shape)
 
 class State(StateBase):
-    def __init__(self):
-        self.player_pos = Pos(7, 4)
-        self.enemy_list = [EnemyX(Pos(1, 1), 3), EnemyY(Pos(13, 9), 2)]
-        self.treasure_list = []
-        self.treasure_pop_timer = 0
+    player_pos = None      # [x, y]
+    enemy_pos = None       # [E, (x, y)]
+    enemy_counter = None   # [E]
+    enemy_grid = None      # [HEIGHT, WIDTH] そのマスにいる敵の数
+    treasure_grid = None   # [HEIGHT, WIDTH] そのマスに宝があるか
+    num_treasures = 0
+    treasure_pop_timer = 0
 
 
 class TreasureGame(AsciiGame):
@@ -85,17 +95,42 @@ class TreasureGame(AsciiGame):
 
     NUM_TREASURES = 20
     MAX_TURN = 800
+    PLAYER_START = (7, 4)
+    ENEMIES = [  # (種類, 最初の x, y, 何ターンに1回動くか)
+        (EnemyX, 1, 1, 3),
+        (EnemyY, 13, 9, 2),
+    ]
     stage = 0
+    treasure_seed = 0  # 宝の出る場所を変える
+    ACTION_SPACE = ActionSpace(AsciiGame.KEYMAP, [(0, AsciiGame.KEY_UP, AsciiGame.KEY_DOWN),
+                                                  (0, AsciiGame.KEY_LEFT, AsciiGame.KEY_RIGHT)])
+
+    def __init__(self, player):
+        super(TreasureGame, self).__init__(player)
+        self.enemy_init_pos = np.array([[x, y] for _, x, y, _ in self.ENEMIES], dtype=np.int32)
+        self.enemy_counter_max = np.array([c for _, _, _, c in self.ENEMIES], dtype=np.int32)
+        self.enemy_chars = np.array([e.CHAR for e, _, _, _ in self.ENEMIES], dtype=np.int8)
+        enemy_classes = [e for e, _, _, _ in self.ENEMIES]
+        self.enemy_groups = [(e, np.array([i for i, c in enumerate(enemy_classes) if c is e]))
+                             for e in sorted(set(enemy_classes), key=enemy_classes.index)]
 
     # must be defined
     def prepare_game(self):
         self.state = State()
         self.state.screen = Screen(self.WIDTH, self.HEIGHT)
+        self.state.player_pos = np.array(self.PLAYER_START, dtype=np.int32)
+        self.state.enemy_pos = self.enemy_init_pos.copy()
+        self.state.enemy_counter = self.enemy_counter_max.copy()
+        self.state.enemy_grid = np.zeros([self.HEIGHT, self.WIDTH], dtype=np.int32)
+        np.add.at(self.state.enemy_grid, (self.state.enemy_pos[:, 1], self.state.enemy_pos[:, 0]), 1)
+        self.state.treasure_grid = np.zeros([self.HEIGHT, self.WIDTH], dtype=np.bool_)
         self.init_course()
         self.draw()
 
     # must be defined
     def get_next_state_and_reward(self, state, action):
+        old_player_pos = state.player_pos.copy()
+        old_enemy_pos = state.enemy_pos.copy()
         self.move_player(state, action)
         self.move_enemies(state)
 
@@ -103,38 +138,51 @@ class TreasureGame(AsciiGame):
         reward = 0
 
         # key penalty -0.5
-        if action not in self.effective_actions():  # 余分なKeyを押したらペナルティとする(親切)
+        if not self.ACTION_SPACE.contains(action):  # 余分なKeyを押したらペナルティとする(親切)
             reward -= 0.5
 
         # got treasure? +0.1
-        pos = state.player_pos
-        for t in copy.copy(state.treasure_list):
-            if t.pos == pos:
-                reward += 0.1
-                state.treasure_list.remove(t)
-                if len(state.treasure_list) == 0:
-                    self.pop_treasures()
+        x, y = state.player_pos
+        if state.treasure_grid[y, x]:
+            reward += 0.1
+            state.treasure_grid[y, x] = False
+            state.num_treasures -= 1
+            if state.num_treasures == 0:
+                self.pop_treasures()
 
         # game over?
-        for e in self.state.enemy_list:
-            if e.pos == pos:
-                self.is_game_over = True
-                reward = -1
-                break
+        if state.enemy_grid[y, x] > 0:
+            self.is_game_over = True
+            reward = -1
 
         if self.turn == self.MAX_TURN:
             self.is_game_over = True
 
-        self.draw()
+        self.draw_moved(old_player_pos, old_enemy_pos)
         return state, reward
 
-    # should be defined
-    def effective_actions(self):
-        ret = set()
-        key_combinations = [(0, self.KEY_UP, self.KEY_DOWN), (0, self.KEY_LEFT, self.KEY_RIGHT)]
-        for key_code_list in itertools.product(*key_combinations):
-            ret.add(reduce(lambda t, x: t | x, key_code_list))
-        return list(ret)
+    def set_seed(self, seed):
+        self.treasure_seed = seed
+
+    # should be defined for snapshot()
+    def pack_entities(self, state):
+        return np.concatenate([[self.stage, state.treasure_pop_timer, self.treasure_seed], state.player_pos,
+                               state.enemy_pos.ravel(), state.enemy_counter, state.treasure_grid.ravel()])
+
+    def unpack_entities(self, state, values):
+        num_enemies = len(self.ENEMIES)
+        values = values.astype(np.int32)
+        self.stage, state.treasure_pop_timer, self.treasure_seed = values[:3]
+        state.player_pos[:] = values[3:5]
+        i = 5
+        state.enemy_pos[:] = values[i:i+num_enemies*2].reshape(num_enemies, 2)
+        i += num_enemies*2
+        state.enemy_counter[:] = values[i:i+num_enemies]
+        i += num_enemies
+        state.treasure_grid[:] = values[i:].reshape(self.HEIGHT, self.WIDTH)
+        state.num_treasures = np.count_nonzero(state.treasure_grid)
+        state.enemy_grid.fill(0)
+        np.add.at(state.enemy_grid, (state.enemy_pos[:, 1], state.enemy_pos[:, 0]), 1)
 
     # private methods
     def init_course(self):
@@ -145,90 +193,140 @@ class TreasureGame(AsciiGame):
     def draw(self):
         screen = self.state.screen
         screen.fill(self.SPACE)
-        for t in self.state.treasure_list:
-            screen[t.pos.y, t.pos.x] = self.TREASURE
-        screen[self.state.player_pos.y, self.state.player_pos.x] = self.PLAYER
-        for e in self.state.enemy_list:
-            screen[e.pos.y, e.pos.x] = e.CHAR
+        screen.data[self.state.treasure_grid] = self.TREASURE
+        self.draw_actors()
+
+    def draw_moved(self, old_player_pos, old_enemy_pos):
+        """Player と敵が居たマスだけ描き直す(宝が全部取られて置き直した時は全部描く)"""
+        if self.state.treasure_pop_timer == self.turn:
+            self.draw()
+            return
+        data = self.state.screen.data
+        ys = np.append(old_enemy_pos[:, 1], old_player_pos[1])
+        xs = np.append(old_enemy_pos[:, 0], old_player_pos[0])
+        data[ys, xs] = np.where(self.state.treasure_grid[ys, xs], self.TREASURE, self.SPACE)
+        self.draw_actors()
+
+    def draw_actors(self):
+        state = self.state
+        data = state.screen.data
+        data[state.player_pos[1], state.player_pos[0]] = self.PLAYER
+        data[state.enemy_pos[:, 1], state.enemy_pos[:, 0]] = self.enemy_chars
 
     def pop_treasures(self):
         self.stage += 1
-        random.seed(self.stage * 1000)
-        for _ in range(self.NUM_TREASURES):
-            self.pop_treasure()
-
-    def pop_treasure(self):
-        while True:
-            pos = Pos(random.randint(0, self.WIDTH-1), random.randint(0, self.HEIGHT-1))
-            if self.state.screen[pos.y, pos.x] == self.SPACE:
-                t = Treasure(pos)
-                self.state.treasure_list.append(t)
-                break
+        ys, xs = choose_treasure_cells(self.state.screen.data, self.stage, self.NUM_TREASURES, self.SPACE,
+                                       self.treasure_seed)
+        self.state.treasure_grid[ys, xs] = True
+        self.state.num_treasures = np.count_nonzero(self.state.treasure_grid)
+        self.state.treasure_pop_timer = self.turn
 
     def move_player(self, state, action):
         pos = state.player_pos
-        if action & self.KEY_LEFT and pos.x > 0:
-            pos.x -= 1
-        if action & self.KEY_RIGHT and pos.x < self.WIDTH-1:
-            pos.x += 1
-        if action & self.KEY_UP and pos.y > 0:
-            pos.y -= 1
-        if action & self.KEY_DOWN and pos.y < self.HEIGHT-1:
-            pos.y += 1
+        left, right, up, down, _, _ = self.pressed_keys(action)
+        if left and pos[0] > 0:
+            pos[0] -= 1
+        if right and pos[0] < self.WIDTH-1:
+            pos[0] += 1
+        if up and pos[1] > 0:
+            pos[1] -= 1
+        if down and pos[1] < self.HEIGHT-1:
+            pos[1] += 1
 
     def move_enemies(self, state):
-        for e in state.enemy_list:
-            e.move(state)
+        grid = state.enemy_grid
+        pos = state.enemy_pos
+        np.subtract.at(grid, (pos[:, 1], pos[:, 0]), 1)
+        move_enemy_positions(pos, state.enemy_counter, self.enemy_counter_max, self.enemy_groups, state.player_pos)
+        np.add.at(grid, (pos[:, 1], pos[:, 0]), 1)
+
+
+class VecTreasureGame(VecAsciiGame):
+    game_class = TreasureGame
+
+    def __init__(self, num_games):
+        template = self.game_class(None)
+        self.enemy_init_pos = template.enemy_init_pos
+        self.enemy_counter_max = template.enemy_counter_max
+        self.enemy_chars = template.enemy_chars
+        self.enemy_groups = template.enemy_groups
+        self.player_init_pos = np.array(template.PLAYER_START, dtype=np.int32)
+
+        num_enemies = len(self.enemy_init_pos)
+        self.player_pos = np.zeros([num_games, 2], dtype=np.int32)                # [N, (x, y)]
+        self.enemy_pos = np.zeros([num_games, num_enemies, 2], dtype=np.int32)    # [N, E, (x, y)]
+        self.enemy_counter = np.zeros([num_games, num_enemies], dtype=np.int32)
+        self.treasures = np.zeros([num_games, template.HEIGHT, template.WIDTH], dtype=np.bool_)
+        self.stages = np.zeros([num_games], dtype=np.int32)
+        super(VecTreasureGame, self).__init__(num_games)
+
+    def prepare_games(self, indices):
+        self.player_pos[indices] = self.player_init_pos
+        self.enemy_pos[indices] = self.enemy_init_pos
+        self.enemy_counter[indices] = self.enemy_counter_max
+        self.treasures[indices] = False
+        self.stages[indices] = 0
+        self.screens[indices] = self.game_class.SPACE
+        for i in indices:
+            self.pop_treasures(i)
+        self.draw()
+
+    def get_next_states_and_rewards(self, actions):
+        g = self.game_class
+        self.move_players(actions)
+        move_enemy_positions(self.enemy_pos, self.enemy_counter, self.enemy_counter_max, self.enemy_groups,
+                     self.player_pos)
+
+        # decide reward
+        rewards = np.where(self.action_space.mask[actions], 0, -0.5).astype(np.float32)
+
+        # got treasure?
+        px, py = self.player_pos[:, 0], self.player_pos[:, 1]
+        got = self.treasures[self.index, py, px]
+        rewards += 0.1 * got
+        self.treasures[self.index, py, px] = False
+        for i in np.flatnonzero(got & ~self.treasures.any(axis=(1, 2))):
+            self.pop_treasures(i)
+
+        # game over?
+        dones = (self.enemy_pos == self.player_pos[:, np.newaxis, :]).all(axis=2).any(axis=1)
+        rewards[dones] = -1
+        dones |= self.turns == g.MAX_TURN
+
+        self.draw()
+        return rewards, dones
+
+    def pop_treasures(self, i):
+        """TreasureGame.pop_treasures() と同じ乱数で宝を置く"""
+        g = self.game_class
+        self.stages[i] += 1
+        ys, xs = choose_treasure_cells(self.screens[i], self.stages[i], g.NUM_TREASURES, g.SPACE)
+        self.treasures[i, ys, xs] = True
+
+    def draw(self):
+        g = self.game_class
+        self.screens.fill(g.SPACE)
+        self.screens[self.treasures] = g.TREASURE
+        self.screens[self.index, self.player_pos[:, 1], self.player_pos[:, 0]] = g.PLAYER
+        for e, ch in enumerate(self.enemy_chars):
+            self.screens[self.index, self.enemy_pos[:, e, 1], self.enemy_pos[:, e, 0]] = ch
+
+    def move_players(self, actions):
+        x, y = self.player_pos[:, 0], self.player_pos[:, 1]
+        x -= self.key_pressed(actions, "LEFT") & (x > 0)
+        x += self.key_pressed(actions, "RIGHT") & (x < self.WIDTH-1)
+        y -= self.key_pressed(actions, "UP") & (y > 0)
+        y += self.key_pressed(actions, "DOWN") & (y < self.HEIGHT-1)
 
 
 def ptn1(ThisGame, model_name):
-    HISTORY_SIZE = 3
-    PATTERN_SIZE1 = 50
-    EMBED_OUT_SIZE = 3
-    KSIZE1 = (3, 3*EMBED_OUT_SIZE)
-    STRIDE1 = (1, 1*EMBED_OUT_SIZE)
-    nw1 = calc_output_size(ThisGame.WIDTH*EMBED_OUT_SIZE, KSIZE1[1], STRIDE1[1])  # 13
-    nh1 = calc_output_size(ThisGame.HEIGHT, KSIZE1[0], STRIDE1[0])                # 8
-
-    PATTERN_SIZE2 = 100
-    KSIZE2  = (3, 3)
-    STRIDE2 = (1, 1)
-    nw2 = calc_output_size(nw1, KSIZE2[1], STRIDE2[1])  # 11
-    nh2 = calc_output_size(nh1, KSIZE2[0], STRIDE2[0])  # 6
-    chainer_model = FunctionSet(
-        l1=F.Convolution2D(HISTORY_SIZE, PATTERN_SIZE1, ksize=KSIZE1, stride=STRIDE1),
-        l2=F.Convolution2D(PATTERN_SIZE1, PATTERN_SIZE2, ksize=KSIZE2, stride=STRIDE2),
-        l3=F.Linear(nw2 * nh2 * PATTERN_SIZE2, 1000),
-        l4=F.Linear(1000, 64),
-    )
-    model = EmbedAgentModel(model=chainer_model, model_name=model_name,
-                            embed_out_size=EMBED_OUT_SIZE,
-                            width=ThisGame.WIDTH, height=ThisGame.HEIGHT,
-                            history_size=HISTORY_SIZE, out_size=64)
-
-    def relu_with_drop_ratio(ratio):
-        def f(x, train=True):
-            return F.dropout(F.relu(x), train=train, ratio=ratio)
-        return f
-
-    def drop_ratio(ratio):
-        def f(x, train=True):
-            return F.dropout(x, train=train, ratio=ratio)
-        return f
-
-    model.activate_functions["l1"] = relu_with_drop_ratio(0.2)
-    model.activate_functions["l2"] = relu_with_drop_ratio(0.4)
-    model.activate_functions["l3"] = relu_with_drop_ratio(0.5)
-    model.activate_functions["l4"] = drop_ratio(0.7)
+    model = build_ptn1_model(ThisGame, model_name)
     player = AsciiGamePlayerAgent(model)
     player.ALPHA = 0.01
     agent_play(ThisGame, player)
 
 
 if __name__ == '__main__':
-    def calc_output_size(screen_size, ksize, stride):
-        return (screen_size - ksize) / stride + 1
-
     if os.environ.get("DEBUG_PLAY", None):
         print "Debug Mode"
         debug_game(TreasureGame)